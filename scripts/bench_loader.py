@@ -0,0 +1,229 @@
+from __future__ import division, print_function
+
+import argparse
+from collections import Counter
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakeplone
+
+fakeplone.install()
+import loader
+
+
+ACCURACY = '/features/metadata/' + fakeplone.ACCURACY_IDS[0]
+REFERENCE = {
+    'access_uri': 'http://www.worldcat.org/oclc/1034731631',
+    'bibliographic_uri': 'https://www.zotero.org/groups/2533/items/QL32DCUE',
+    'citation_detail': 'p. 12',
+    'formatted_citation': 'Baird, Jennifer A. Dura-Europos. London: '
+    'Bloomsbury, 2018.',
+    'identifier': '978-1-4725-2365-5; 978-1-4725-2673-1',
+    'short_title': 'Baird 2018',
+}
+ATTESTATIONS = [
+    {'confidence': 'confident', 'timePeriod': 'twentieth-ce'},
+    {'confidence': 'confident', 'timePeriod': 'twenty-first-ce'},
+]
+
+
+def make_places(count, names, locations, connections):
+    """Return a synthetic import shaped like the converter's output.
+
+    Each place connects to the places just before it, so all connections
+    can be made immediately, except that every tenth place also connects
+    forward and has its connections deferred.
+    """
+    places = []
+    for i in range(count):
+        title = 'Block {}'.format(i)
+        targets = ['Block {}'.format(j)
+                   for j in range(max(0, i - connections), i)]
+        cycle = i % 10 == 9 and i + 1 < count
+        if cycle:
+            targets.append('Block {}'.format(i + 1))
+        places.append({
+            'title': title,
+            'description': 'A block with traces {}.'.format(i),
+            'placeType': ['city-block'],
+            'references': [REFERENCE],
+            'connectionCycle': cycle,
+            'names': [{
+                'nameTransliterated': 'Block {} name {}'.format(i, k),
+                'nameAttested': 'B{}/{}'.format(i, k),
+                'nameLanguage': 'en',
+                'nameType': 'geographic',
+                'attestations': ATTESTATIONS,
+            } for k in range(names)],
+            'locations': [{
+                'title': 'Location {} of block {}'.format(k, i),
+                'accuracy': ACCURACY,
+                'archaeologicalRemains': 'traces',
+                'featureType': ['city-block'],
+                'attestations': ATTESTATIONS,
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [40.7 + i * 1e-5, 34.7 + k * 1e-5]},
+            } for k in range(locations)],
+            'connections': [{
+                'connection': target,
+                'relationshipType': 'part_of_physical'}
+                for target in targets],
+        })
+    return places
+
+
+class Tally(object):
+    """Running totals of wall time, simulated latency and calls."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.simulated = 0.0
+        self.calls = Counter()
+
+    def run(self, func, *args):
+        before = Counter(fakeplone.calls.counts)
+        simulated = fakeplone.calls.simulated
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.seconds += time.time() - start
+            self.simulated += fakeplone.calls.simulated - simulated
+            self.calls.update(fakeplone.calls.counts - before)
+
+    def subtract(self, other):
+        self.seconds -= other.seconds
+        self.simulated -= other.simulated
+        self.calls.subtract(other.calls)
+        self.calls = Counter(
+            {name: n for name, n in self.calls.items() if n > 0})
+
+    def to_dict(self, places):
+        seconds = self.seconds
+        if not fakeplone.calls.sleep:
+            seconds += self.simulated
+        count = max(1, places)
+        return {
+            'places': places,
+            'seconds': round(seconds, 6),
+            'simulated_seconds': round(self.simulated, 6),
+            'ms_per_place': round(1000 * seconds / count, 4),
+            'calls': dict(self.calls),
+            'calls_per_place': round(sum(self.calls.values()) / count, 2),
+        }
+
+
+def record(report, label, tally, places):
+    report[label] = entry = tally.to_dict(places)
+    print('{:<12} {:>8} places {:>10.4f} ms/place {:>8.1f} calls/place'.format(
+        label, places, entry['ms_per_place'], entry['calls_per_place']))
+
+
+def bench_populate(places, args, report):
+    """Benchmark the populate_* functions, each on fresh containers."""
+    folder = loader.places_folder
+    contents = []
+    for i, place in enumerate(places):
+        folder.invokeFactory('Place', id='bench-{}'.format(i))
+        contents.append(folder['bench-{}'.format(i)])
+
+    def fields():
+        for place, content in zip(places, contents):
+            for k in ['description', 'placeType', 'references']:
+                loader.populate_field(content, k, place[k])
+
+    def names():
+        for place, content in zip(places, contents):
+            loader.populate_names(place, content, args)
+
+    def locations():
+        for place, content in zip(places, contents):
+            loader.populate_locations(place, content, args)
+
+    for label, func in [('fields', fields), ('names', names),
+                        ('locations', locations)]:
+        tally = Tally()
+        tally.run(func)
+        record(report, label, tally, len(places))
+
+
+def bench_load(places, args, report):
+    """Benchmark the load phases: places, deferred connections and commits.
+
+    Commits (reindexing and transaction.commit) happen inside the first two
+    phases; their cost is taken out of those and reported separately.
+    """
+    commit_batch = loader.commit_batch
+    commits = Tally()
+    loader.commit_batch = lambda args: commits.run(commit_batch, args)
+    try:
+        tally = Tally()
+        tally.run(loader.run_batches, iter(places), loader.load_place,
+                  loader.unload_place, args)
+        tally.subtract(commits)
+        record(report, 'places', tally, len(places))
+        places_commits = commits
+        commits = Tally()
+
+        pending = list(loader.connections_pending.items())
+        tally = Tally()
+        tally.run(loader.run_batches, pending, loader.load_connections,
+                  lambda item: None, args)
+        tally.subtract(commits)
+        record(report, 'connections', tally, len(pending))
+    finally:
+        loader.commit_batch = commit_batch
+    commits.seconds += places_commits.seconds
+    commits.simulated += places_commits.simulated
+    commits.calls.update(places_commits.calls)
+    record(report, 'commits', commits, len(places))
+
+
+def parse_latency(value):
+    name, _, seconds = value.partition('=')
+    return name, float(seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark loader.py against an in-memory fake Plone '
+        'site, reporting cost per place and call counts.')
+    parser.add_argument('--places', default=1000, type=int, dest='places',
+                        help='Number of synthetic places.')
+    parser.add_argument('--names', default=2, type=int, dest='names',
+                        help='Names per place.')
+    parser.add_argument('--locations', default=1, type=int, dest='locations',
+                        help='Locations per place.')
+    parser.add_argument('--connections', default=2, type=int,
+                        dest='connections', help='Connections per place.')
+    parser.add_argument('--latency', action='append', default=[],
+                        type=parse_latency, dest='latency',
+                        help='Simulated latency of a call, as NAME=SECONDS, '
+                        'e.g. transaction.commit=0.05. Repeatable.')
+    parser.add_argument('--sleep', action='store_true', default=False,
+                        dest='sleep', help='Really sleep for simulated '
+                        'latency instead of adding it to the timings.')
+    parser.add_argument('--report', default=None, dest='report',
+                        help='Write the results as JSON to this path.')
+    bench_args = parser.parse_args()
+
+    fakeplone.calls.latency = dict(bench_args.latency)
+    fakeplone.calls.sleep = bench_args.sleep
+    places = make_places(bench_args.places, bench_args.names,
+                         bench_args.locations, bench_args.connections)
+    args = loader.make_parser().parse_args(['--nolist', os.devnull])
+    args.file.close()
+    report = {}
+
+    loader.begin_load(fakeplone.make_site(), args)
+    bench_populate(places, args, report)
+    loader.begin_load(fakeplone.make_site(), args)
+    bench_load(places, args, report)
+
+    if bench_args.report:
+        with open(bench_args.report, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
@@ -4,12 +4,21 @@
 Convert YDEA data for Pleiades
 """
 
-from hashlib import new
 from airtight.cli import configure_commandline
-from copy import copy
+import chardet
+import codecs
+import collections
+from collections import Counter
+import csv
 import encoded_csv
+from functools import lru_cache
+import hashlib
+import io
 import json
 import logging
+import mmap
+import multiprocessing
+import os
 from pprint import pformat, pprint
 import re
 from shapely.geometry import shape, mapping, polygon
@@ -61,12 +70,41 @@ OPTIONAL_ARGUMENTS = [
         "very verbose output (logging level == DEBUG)",
         False,
     ],
-    ["-t", "--fault_tolerant", False, "throw fewer exceptions", False],
+    [
+        "-t",
+        "--fault_tolerant",
+        False,
+        "quarantine failing rows and write an error report instead of stopping",
+        False,
+    ],
+    [
+        "-d",
+        "--emit-digest",
+        False,
+        "write a per-place content hash file next to the output",
+        False,
+    ],
+    [
+        "-p",
+        "--processes",
+        1,
+        "number of worker processes for memory-mapped, chunk-parallel CSV "
+        + "parsing (1 parses serially)",
+        False,
+    ],
+    [
+        "-s",
+        "--stream",
+        False,
+        "write NDJSON, one place per line, as soon as each place is ready to "
+        + "load (outfile - is standard output)",
+        False,
+    ],
 ]
 POSITIONAL_ARGUMENTS = [
     # each row is a list with 3 elements: name, type, help
     ["infile", str, "path to input csv file"],
-    ["outfile", str, "path to output json file"],
+    ["outfile", str, "path to output json file (- for standard output)"],
 ]
 PLACE_TYPES = {
     "tower (wall)": "tower-wall",
@@ -104,6 +142,14 @@ PLACE_TYPES = {
     "platform": "platform",
     "sanctuary": "sanctuary",
 }
+ENCODING_SAMPLE_BYTES = 64 * 1024
+QUOTE_SCAN_BYTES = 16 * 1024 * 1024
+MIN_CHUNK_BYTES = 1024 * 1024
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
 RX_BCE = re.compile(r"(\d+)(\-\d+)? BCE")
 RX_CE = re.compile(r"(\d+)(\-\d+)? CE")
 CENTURY_TERMS = {
@@ -283,6 +329,210 @@ CONNECTION_TARGETS = {
 }
 
 
+NAME_ATTESTATIONS = ("twentieth-ce", "twenty-first-ce")
+# ASCII-only, like the Python 2 regular expressions loader.py used for ids
+RX_ID_PUNCTUATION = re.compile(r"[^\w\s]", re.ASCII)
+# what undecodable bytes turn into when decoding with "surrogateescape"
+RX_UNDECODABLE = re.compile("[\udc80-\udcff]")
+
+
+class RowError(RuntimeError):
+    """
+    A problem with a single input row, tagged with a category for reporting
+    """
+
+    def __init__(self, category: str, message: str):
+        super().__init__(message)
+        self.category = category
+
+
+class ErrorReport:
+    """
+    Per-row errors collected in fault-tolerant mode, with counts by category
+
+    row and title identify the row currently being converted, so that
+    problems which do not quarantine the row can be noted where they occur.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.counts = Counter()
+        self.quarantined = 0
+        self.row = None
+        self.title = None
+
+    def add(self, row, title, category: str, message: str, quarantined=True):
+        self.entries.append(
+            {
+                "row": row,
+                "title": title,
+                "category": category,
+                "message": message,
+                "quarantined": quarantined,
+            }
+        )
+        self.counts[category] += 1
+        if quarantined:
+            self.quarantined += 1
+
+    def note(self, category: str, message: str):
+        self.add(self.row, self.title, category, message, quarantined=False)
+
+    def to_dict(self):
+        return {
+            "counts": dict(sorted(self.counts.items())),
+            "quarantined_rows": self.quarantined,
+            "errors": sorted(self.entries, key=lambda entry: entry["row"]),
+        }
+
+
+errors = ErrorReport()
+
+
+class Name:
+    """
+    A name of a place; every field but the alias is a shared constant
+    """
+
+    __slots__ = ("alias", "id")
+
+    def __init__(self, alias: str):
+        self.alias = alias
+        self.id = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "nameLanguage": "en",
+            "nameTransliterated": self.alias,
+            "nameAttested": self.alias,
+            "nameType": "geographic",
+            "attestations": attestations_to_dicts(NAME_ATTESTATIONS),
+        }
+
+
+class Location:
+    """
+    A location of a place, holding its geometry as a shapely object
+    """
+
+    __slots__ = (
+        "title",
+        "geometry",
+        "remains",
+        "accuracy",
+        "attestations",
+        "feature_types",
+        "id",
+    )
+
+    def __init__(self, title, geometry, remains, accuracy, attestations, feature_types):
+        self.title = title
+        self.geometry = geometry
+        self.remains = remains
+        self.accuracy = accuracy
+        self.attestations = attestations
+        self.feature_types = feature_types
+        self.id = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "geometry": mapping(self.geometry),
+            "archaeologicalRemains": self.remains,
+            "accuracy": self.accuracy,
+            "attestations": attestations_to_dicts(self.attestations),
+            "featureType": list(self.feature_types),
+        }
+
+
+class Reference:
+    """
+    A citation of one of the works in REFERENCES
+    """
+
+    __slots__ = ("short_title", "citation_detail")
+
+    def __init__(self, short_title: str, citation_detail=None):
+        self.short_title = short_title
+        self.citation_detail = citation_detail
+
+    def to_dict(self):
+        d = dict(REFERENCES[self.short_title])
+        d["short_title"] = self.short_title
+        if self.citation_detail is not None:
+            d["citation_detail"] = self.citation_detail
+        return d
+
+
+class Connection:
+    """
+    A connection to another place, by title or Pleiades URI
+    """
+
+    __slots__ = ("target", "relationship_type", "id")
+
+    def __init__(self, target: str, relationship_type: str):
+        self.target = target
+        self.relationship_type = relationship_type
+        self.id = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "connection": self.target,
+            "relationshipType": self.relationship_type,
+        }
+
+
+class Place:
+    """
+    A place and its subordinate records; converted to a dict only when written
+    """
+
+    __slots__ = (
+        "title",
+        "description",
+        "place_types",
+        "names",
+        "locations",
+        "references",
+        "connections",
+        "connection_cycle",
+        "row",
+    )
+
+    def __init__(self, title, description, place_types, names, locations, references):
+        self.title = title
+        self.description = description
+        self.place_types = place_types
+        self.names = names
+        self.locations = locations
+        self.references = references
+        self.connections = ()
+        self.connection_cycle = False
+        self.row = None
+
+    def to_dict(self):
+        d = {
+            "title": self.title,
+            "description": self.description,
+            "placeType": list(self.place_types),
+            "names": [name.to_dict() for name in self.names],
+            "locations": [location.to_dict() for location in self.locations],
+            "references": [reference.to_dict() for reference in self.references],
+            "connections": [connection.to_dict() for connection in self.connections],
+        }
+        if self.connection_cycle:
+            d["connectionCycle"] = True
+        return d
+
+
+def attestations_to_dicts(periods: tuple):
+    return [{"timePeriod": period, "confidence": "confident"} for period in periods]
+
+
 def titleize(val: str):
     # oh the pain
     t = val.title()
@@ -313,14 +563,20 @@ def titleize(val: str):
     return t
 
 
-def read_ydea(fn: str):
-    r = encoded_csv.get_csv(fn, sample_lines=2000)
+def read_ydea(fn: str, processes: int = 1):
+    r = None
+    if processes > 1:
+        r = read_csv_parallel(fn, processes)
+    if r is None:
+        r = encoded_csv.get_csv(fn, sample_lines=2000)
 
     new_fieldnames = []
     for fn in r["fieldnames"]:
         if fn != fn.strip():
             new_fn = fn.strip()
             for row in r["content"]:
+                if isinstance(row, RowError):
+                    continue  # a record that could not be read
                 row[new_fn] = row[fn]
                 row.pop(fn)
             new_fieldnames.append(new_fn)
@@ -345,6 +601,205 @@ def read_ydea(fn: str):
     return r["content"]
 
 
+def read_csv_parallel(fn: str, processes: int):
+    """
+    Read a CSV file by memory-mapping it and parsing chunks in worker processes
+
+    Returns a dictionary shaped like the one encoded_csv.get_csv() returns, or
+    None if the file has to be parsed serially instead: when its encoding does
+    not allow splitting it on raw bytes, or when a chunk turns out not to end
+    on a record boundary.
+    """
+    with open(fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start, encoding = detect_encoding(mm)
+        if '\n"'.encode(encoding) != b'\n"':
+            logger.warning(
+                f"Cannot split {encoding} input on record boundaries; "
+                "parsing serially."
+            )
+            return None
+        sample = decode_sample(mm[start : start + ENCODING_SAMPLE_BYTES], encoding)
+        dialect = csv.Sniffer().sniff(sample[: sample.rfind("\n") + 1] or sample)
+        dialect = {
+            "delimiter": dialect.delimiter,
+            "doublequote": dialect.doublequote,
+            "escapechar": dialect.escapechar,
+            "quotechar": dialect.quotechar,
+            "quoting": dialect.quoting,
+            "skipinitialspace": dialect.skipinitialspace,
+        }
+        quotechar = dialect["quotechar"].encode(encoding)
+        size = len(mm)
+        header_end = split_records(mm, start, [start], quotechar)
+        header_end = header_end[0] if header_end else size
+        header = mm[start:header_end].decode(encoding)
+        fieldnames = next(csv.reader(io.StringIO(header, newline=""), **dialect))
+        parts = max(1, min(processes * 4, (size - header_end) // MIN_CHUNK_BYTES))
+        targets = [
+            header_end + (size - header_end) * i // parts for i in range(1, parts)
+        ]
+        boundaries = [header_end]
+        for boundary in split_records(mm, header_end, targets, quotechar):
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        if boundaries[-1] < size:
+            boundaries.append(size)
+    jobs = [
+        (fn, boundaries[i], boundaries[i + 1], encoding, dialect, fault_tolerant)
+        for i in range(len(boundaries) - 1)
+    ]
+    logger.info(
+        f"Parsing {len(jobs)} chunks of {fn} ({encoding}) "
+        f"with {processes} processes."
+    )
+    chunks = []
+    with multiprocessing.Pool(processes) as pool:
+        # imap hands back chunks in file order
+        for rows in pool.imap(parse_chunk, jobs):
+            if rows is None:
+                # the quote count put a boundary inside a quoted field, e.g.
+                # because of a quote character in an unquoted field
+                logger.warning(
+                    f"A chunk of {fn} does not end on a record boundary; "
+                    "parsing serially."
+                )
+                return None
+            chunks.append(rows)
+    content = []
+    width = len(fieldnames)
+    for rows in chunks:
+        for values in rows:
+            if isinstance(values, tuple):
+                # a record the worker could not read (fault-tolerant mode)
+                # keeps its place, so that rows are numbered as if it had
+                # been read, and is quarantined by build_rows()
+                content.append(RowError(*values))
+                continue
+            if not values:
+                continue  # csv.DictReader skips blank rows too
+            # ragged records come out as csv.DictReader makes them
+            row = dict(zip(fieldnames, values))
+            if len(values) > width:
+                row[None] = values[width:]
+            for key in fieldnames[len(values) :]:
+                row[key] = None
+            content.append(row)
+    return {"fieldnames": fieldnames, "content": content}
+
+
+def detect_encoding(mm):
+    """
+    Return the offset past any BOM and the encoding, using a bounded sample
+    """
+    for bom, encoding in BOMS:
+        if mm[: len(bom)] == bom:
+            return len(bom), encoding
+    sample = mm[:ENCODING_SAMPLE_BYTES]
+    try:
+        decode_sample(sample, "utf-8")
+    except UnicodeDecodeError:
+        return 0, chardet.detect(sample)["encoding"]
+    return 0, "utf-8"
+
+
+def decode_sample(sample: bytes, encoding: str):
+    # the sample may end in the middle of a multibyte character
+    return codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+
+
+def split_records(mm, start: int, targets: list, quotechar: bytes):
+    """
+    Find the first record boundary at or after each target offset
+
+    start must itself be a record boundary. A newline ends a record only if
+    an even number of quote characters lies between start and the newline,
+    which also holds for doubled (escaped) quotes, so newlines inside quoted
+    fields are not mistaken for boundaries as long as quote characters only
+    occur in quoted fields. parse_chunk() checks that each chunk really ends
+    on a boundary. Targets past the last record boundary are dropped.
+    """
+    boundaries = []
+    quotes = 0
+    scanned = start
+    pos = start
+    for target in targets:
+        pos = max(target, pos)
+        while True:
+            nl = mm.find(b"\n", pos)
+            if nl == -1:
+                return boundaries
+            quotes += count_bytes(mm, quotechar, scanned, nl)
+            scanned = nl
+            pos = nl + 1
+            if quotes % 2 == 0:
+                break
+        boundaries.append(pos)
+    return boundaries
+
+
+def count_bytes(mm, needle: bytes, start: int, end: int):
+    # count in bounded slices so memory use does not grow with the file
+    count = 0
+    for i in range(start, end, QUOTE_SCAN_BYTES):
+        count += mm[i : min(i + QUOTE_SCAN_BYTES, end)].count(needle)
+    return count
+
+
+def parse_chunk(job):
+    """
+    Parse the CSV records in one byte range of a file (runs in a worker)
+
+    In fault-tolerant mode a record that cannot be parsed or decoded is handed
+    back as a (category, message) pair instead of a list of values. Returns
+    None if the chunk does not end on a record boundary, i.e. its last record
+    does not parse strictly: a chunk that starts on a boundary and ends inside
+    a quoted field is what a wrongly placed boundary leaves behind.
+    """
+    fn, start, end, encoding, dialect, tolerant = job
+    with open(fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode(
+            encoding, "surrogateescape" if tolerant else "strict"
+        )
+    # universal newlines, as encoded_csv reads the file
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    consumed = 0
+
+    def lines():
+        # csv.reader reads no further ahead than the record it returns
+        nonlocal consumed
+        for line in io.StringIO(text, newline=""):
+            consumed += len(line)
+            yield line
+
+    rows = []
+    reader = csv.reader(lines(), **dialect)
+    last_record = 0
+    while True:
+        record = consumed
+        try:
+            values = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as err:
+            if not tolerant:
+                raise
+            rows.append(("csv", f"csv.Error: {err}"))
+            last_record = record
+            continue
+        if tolerant and any(RX_UNDECODABLE.search(value) for value in values):
+            rows.append(("encoding", f"Record is not valid {encoding}."))
+        else:
+            rows.append(values)
+        last_record = record
+    if rows:
+        tail = io.StringIO(text[last_record:], newline="")
+        try:
+            list(csv.reader(tail, strict=True, **dialect))
+        except csv.Error:
+            return None
+    return rows
+
+
 def determine_field_key_variant(fieldnames=set, options: list = []):
     for k in options:
         if k in fieldnames:
@@ -386,20 +841,7 @@ def build_names(feature):
             break
     if isinstance(aliases, str):
         aliases = [aliases]
-    names = []
-    for alias in aliases:
-        name = {
-            "nameLanguage": "en",
-            "nameTransliterated": alias,
-            "nameAttested": alias,
-            "nameType": "geographic",
-            "attestations": [
-                {"timePeriod": "twentieth-ce", "confidence": "confident"},
-                {"timePeriod": "twenty-first-ce", "confidence": "confident"},
-            ],
-        }
-        names.append(name)
-    return names
+    return [Name(alias) for alias in aliases]
 
 
 def parse_year(raw: str):
@@ -424,39 +866,47 @@ def parse_year(raw: str):
 def build_attestations(feature):
     start = feature[read_keys["inception"]].strip()
     end = feature[read_keys["dissolution"]].strip()
-    attestations = []
+    return attestation_periods(start, end)
+
+
+@lru_cache(maxsize=None)
+def attestation_periods(start: str, end: str):
+    """
+    Return the tuple of century terms spanned by raw start and end dates
+
+    Cached, so places with the same dates share a single immutable tuple.
+    """
+    try:
+        return tuple(century_terms(start, end))
+    except (KeyError, ValueError) as err:
+        raise RowError(
+            "date", f'Cannot date "{start}" to "{end}": {err.__class__.__name__}: {err}'
+        )
+
+
+def century_terms(start: str, end: str):
+    periods = []
     if start != "" and end != "":
         start = parse_year(start)
         end = parse_year(end)
         start_century = -(-start // 100)
         end_century = -(-end // 100)
         if start_century == end_century:
-            attestations.append(
-                {
-                    "timePeriod": CENTURY_TERMS[str(start_century)],
-                    "confidence": "confident",
-                }
-            )
+            periods.append(CENTURY_TERMS[str(start_century)])
         else:
             for i in range(start_century, end_century):
                 if i == 0:
                     continue  # out, vile astronomers!
-                attestations.append(
-                    {"timePeriod": CENTURY_TERMS[str(i)], "confidence": "confident"}
-                )
+                periods.append(CENTURY_TERMS[str(i)])
     elif start != "":
         start = parse_year(start)
         start_century = -(-start // 100)
-        attestations.append(
-            {"timePeriod": CENTURY_TERMS[str(start_century)], "confidence": "confident"}
-        )
+        periods.append(CENTURY_TERMS[str(start_century)])
     elif end != "":
         end = parse_year(end)
         end_century = -(-end // 100)
-        attestations.append(
-            {"timePeriod": CENTURY_TERMS[str(end_century)], "confidence": "confident"}
-        )
-    return attestations
+        periods.append(CENTURY_TERMS[str(end_century)])
+    return periods
 
 
 def build_location_title(feature):
@@ -497,6 +947,24 @@ def build_location_title(feature):
     return " ".join((title, feature[read_keys["title"]]))
 
 
+def build_place_types(feature):
+    return place_type_terms(feature[read_keys["place_type"]])
+
+
+@lru_cache(maxsize=None)
+def place_type_terms(raw: str):
+    # sorted so that output does not depend on string hash randomization
+    terms = set()
+    for pt in raw.split(";"):
+        if pt.strip() == "":
+            continue
+        try:
+            terms.add(PLACE_TYPES[pt.lower().strip()])
+        except KeyError:
+            raise RowError("place_type", f'Unknown place type "{pt.strip()}".')
+    return tuple(sorted(terms))
+
+
 def build_remains(feature):
     if "traces" in feature[read_keys["description"]]:
         return "traces"
@@ -561,27 +1029,20 @@ def build_locations(feature):
             #         logger.error(msg)
             #     else:
             #         raise RuntimeError(msg)
-            location = {
-                "title": build_location_title(feature),
-                "geometry": mapping(s),
-                "archaeologicalRemains": build_remains(feature),
-                "accuracy": "/features/metadata/" + accuracy_id,
-                "attestations": build_attestations(feature),
-                "featureType": list(
-                    set(
-                        [
-                            PLACE_TYPES[pt.lower().strip()]
-                            for pt in feature[read_keys["place_type"]].split(";")
-                            if pt.strip() != ""
-                        ]
-                    )
-                ),
-            }
+            location = Location(
+                title=build_location_title(feature),
+                geometry=s,
+                remains=build_remains(feature),
+                accuracy="/features/metadata/" + accuracy_id,
+                attestations=build_attestations(feature),
+                feature_types=build_place_types(feature),
+            )
             locations.append(location)
         else:
             msg = '{} (title: "{}")'.format(explain_validity(s), t_text)
             if fault_tolerant:
                 logger.error(msg)
+                errors.note("geometry", msg)
             else:
                 raise ValueError(msg)
     return locations
@@ -606,13 +1067,11 @@ def parse_connections(target_string, ctype=None):
             except KeyError:
                 real_target = target
 
-        connections.append(
-            {"connection": real_target, "relationshipType": relationship_type}
-        )
+        connections.append(Connection(real_target, relationship_type))
     return connections
 
 
-def build_connections(feature, places={}):
+def build_connections(feature):
     connections = []
     categories = [
         ("location", "at"),
@@ -636,9 +1095,16 @@ def build_connections(feature, places={}):
         except KeyError:
             pass
     if connections:
-        logger.debug(connections)
-    for connection in connections:
-        target_string = connection["connection"].strip()
+        logger.debug([connection.to_dict() for connection in connections])
+    return connections
+
+
+def resolve_connections(place, places):
+    """
+    Match the targets of a place's connections to the titles of other places
+    """
+    for connection in place.connections:
+        target_string = connection.target.strip()
         if target_string.startswith("https://pleiades.stoa.org/places/"):
             continue
         try:
@@ -648,16 +1114,15 @@ def build_connections(feature, places={}):
             try:
                 places[target_string]
             except KeyError:
-                keys = list(places.keys())
-                keys.sort()
-                keys = "".join([f"\t{k}\n" for k in keys])
-                t = titleize(feature[read_keys["title"]])
-                raise RuntimeError(
-                    f'Failed connection title match for {t}: "{target_string}".\nAvailable keys:\n{keys}.'
-                )
+                msg = f'Failed connection title match for {place.title}: "{target_string}".'
+                if not fault_tolerant:
+                    keys = list(places.keys())
+                    keys.sort()
+                    keys = "".join([f"\t{k}\n" for k in keys])
+                    msg += f"\nAvailable keys:\n{keys}."
+                raise RowError("connection", msg)
             else:
-                connection["connection"] = target_string
-    return connections
+                connection.target = target_string
 
 
 def build_references(feature):
@@ -676,14 +1141,7 @@ def build_references(feature):
                 for removal in removals:
                     short_title = short_title.replace(removal, "")
                 short_title = " ".join(short_title.split()).strip()
-                reference = copy(REFERENCES[short_title])
-                reference["short_title"] = short_title
-                try:
-                    citation_detail = m.group(2)
-                except IndexError:
-                    pass
-                else:
-                    reference["citation_detail"] = citation_detail
+                reference = build_reference(short_title, m)
                 references.append(reference)
         if reference is None:
             failures.append(source)
@@ -692,6 +1150,16 @@ def build_references(feature):
     return references
 
 
+def build_reference(short_title: str, m):
+    if short_title not in REFERENCES:
+        raise RowError("reference", f'Unknown citation "{short_title}".')
+    try:
+        citation_detail = m.group(2)
+    except IndexError:
+        citation_detail = None
+    return Reference(short_title, citation_detail)
+
+
 def mine_references(sources: list):
     # are there any references buried in longer discursive text?
 
@@ -705,57 +1173,371 @@ def mine_references(sources: list):
                 for removal in removals:
                     short_title = short_title.replace(removal, "")
                 short_title = " ".join(short_title.split()).strip()
-                reference = copy(REFERENCES[short_title])
-                reference["short_title"] = short_title
-                try:
-                    citation_detail = m.group(2)
-                except IndexError:
-                    pass
-                else:
-                    reference["citation_detail"] = citation_detail
+                reference = build_reference(short_title, m)
                 references.append(reference)
     return references
 
 
 def make_pjson(in_data):
+    """
+    Build Place records from the rows of in_data
+
+    In fault-tolerant mode places whose connections point at a missing or
+    quarantined place are quarantined in turn.
+    """
     places = {}
-    features_by_title = {}
-    for i, feature in enumerate(in_data):
-        k = read_keys["title"]
-        title = titleize(feature[k].strip())
+    for place in build_rows(in_data, places):
+        places[place.title] = place
+
+    pending = list(places.values())
+    while pending:
+        failed = set()
+        for place in pending:
+            try:
+                resolve_connections(place, places)
+            except RowError as err:
+                if not fault_tolerant:
+                    raise
+                logger.error(f"Quarantined row {place.row} ({err.category}): {err}")
+                errors.add(place.row, place.title, err.category, str(err))
+                failed.add(place.title)
+        for title in failed:
+            del places[title]
+        pending = [
+            place
+            for place in places.values()
+            if any(connection.target in failed for connection in place.connections)
+        ]
+
+    for place in places.values():
+        assign_ids(place)
+
+    # write connection targets ahead of the places that connect to them, so
+    # a loader can create each place's connections as soon as it has created
+    # the place; only members of a connection cycle need to be deferred
+    ordered, cyclic = order_places(build_connection_graph(places))
+    if cyclic:
+        logger.info(
+            f"{len(cyclic)} places are members of connection cycles: "
+            f"{pformat(sorted(cyclic), indent=4)}"
+        )
+    for title in cyclic:
+        places[title].connection_cycle = True
+    return [places[title] for title in ordered]
+
+
+def build_rows(in_data, places):
+    """
+    Yield a Place record for each row of in_data
+
+    The caller adds each place to places before asking for the next one.
+    Each row is released from in_data once its place is built, so the raw
+    input does not stay in memory alongside the records.
+
+    In fault-tolerant mode a row that cannot be converted is quarantined
+    (left out of the output and recorded in errors) and processing goes on.
+    """
+    for i in range(len(in_data)):
+        feature = in_data[i]
+        in_data[i] = None
+        errors.row = i + 1
+        errors.title = None
         try:
-            places[title]
-        except KeyError:
-            features_by_title[title] = feature
+            if isinstance(feature, RowError):
+                raise feature  # the CSV reader could not read this record
+            place = build_place(feature, places)
+        except Exception as err:
+            if not fault_tolerant:
+                raise
+            category = getattr(err, "category", "other")
+            msg = str(err)
+            if not isinstance(err, RowError):
+                msg = f"{err.__class__.__name__}: {msg}"
+            logger.error(f"Quarantined row {errors.row} ({category}): {msg}")
+            errors.add(errors.row, errors.title, category, msg)
+            continue
+        place.row = i + 1
+        yield place
+
+
+def stream_places(in_data):
+    """
+    Build Place records and yield each one as soon as it is ready to load
+
+    A place is ready once every place in this import that it connects to has
+    been yielded, so a loader reading the stream can make each place's
+    connections right after creating it. Places still waiting when the rows
+    run out are in or behind a connection cycle, or connect to a title that
+    never appeared, which is an error as in make_pjson(). The rest are
+    yielded last, ordered and with their cycles marked as in make_pjson().
+    """
+    places = {}  # title -> Place while held, None once yielded
+    waiting = {}  # title of a held place -> titles it is waiting for
+    waiters = {}  # title -> titles of held places waiting for it
+
+    def release(place):
+        ready = collections.deque([place])
+        while ready:
+            place = ready.popleft()
+            assign_ids(place)
+            yield place
+            places[place.title] = None
+            for title in waiters.pop(place.title, ()):
+                targets = waiting[title]
+                targets.remove(place.title)
+                if not targets:
+                    del waiting[title]
+                    ready.append(places[title])
+
+    for place in build_rows(in_data, places):
+        places[place.title] = place
+        targets = []
+        for connection in place.connections:
+            target = connection.target.strip()
+            if target.startswith("https://pleiades.stoa.org/places/"):
+                continue
+            if target not in places:
+                # place titles are titleized, so a later place can only
+                # match in that form
+                target = titleize(target)
+            connection.target = target
+            if places.get(target, place) is not None and target not in targets:
+                targets.append(target)
+        if targets:
+            waiting[place.title] = targets
+            for target in targets:
+                waiters.setdefault(target, []).append(place.title)
         else:
-            raise RuntimeError(f'Title collision error with "{title}".')
-        place = {
-            "title": title,
-            "description": build_description(feature),
-            "placeType": list(
-                set(
-                    [
-                        PLACE_TYPES[pt.lower().strip()]
-                        for pt in feature[read_keys["place_type"]].split(";")
-                        if pt.strip() != ""
-                    ]
-                )
-            ),
-            "names": build_names(feature),
-            "locations": build_locations(feature),
-            # 'connections': build_connections(feature),
-            "references": build_references(feature),
-        }
-        places[title] = place
+            yield from release(place)
+
+    while True:
+        failed = [
+            title
+            for title, targets in waiting.items()
+            if any(target not in places for target in targets)
+        ]
+        if not failed:
+            break
+        for title in failed:
+            place = places.pop(title)
+            target = next(t for t in waiting.pop(title) if t not in places)
+            msg = f'Failed connection title match for {title}: "{target}".'
+            if not fault_tolerant:
+                raise RowError("connection", msg)
+            logger.error(f"Quarantined row {place.row} (connection): {msg}")
+            errors.add(place.row, title, "connection", msg)
+
+    ordered, cyclic = order_places(waiting)
+    if cyclic:
+        logger.info(
+            f"{len(cyclic)} places are members of connection cycles: "
+            f"{pformat(sorted(cyclic), indent=4)}"
+        )
+    for title in ordered:
+        place = places[title]
+        place.connection_cycle = title in cyclic
+        assign_ids(place)
+        yield place
+
+
+def build_place(feature, places):
+    k = read_keys["title"]
+    title = titleize(feature[k].strip())
+    errors.title = title
+    try:
+        places[title]
+    except KeyError:
+        pass
+    else:
+        raise RowError("title_collision", f'Title collision error with "{title}".')
+    place = Place(
+        title=title,
+        description=build_description(feature),
+        place_types=build_place_types(feature),
+        names=build_names(feature),
+        locations=build_locations(feature),
+        references=build_references(feature),
+    )
+    # connections are parsed now but matched to titles once all places exist
+    place.connections = build_connections(feature)
+    return place
 
+
+def make_object_id(title: str):
+    """
+    Derive a Plone object id from a title, as scripts/loader.py always has
+    """
+    this_id = title.split(",")[0].strip()
+    this_id = RX_ID_PUNCTUATION.sub("", this_id)
+    this_id = this_id.replace("_", "-")
+    this_id = "-".join(this_id.lower().split())
+    while "--" in this_id:
+        this_id = this_id.replace("--", "-")
+    return this_id.strip("-")
+
+
+def assign_ids(place):
+    """
+    Give each name, location and connection of a place a unique object id
+
+    They all become children of the place, so ids must differ within it. In
+    the order the loader creates them, an object whose id is already taken
+    gets the first free numeric suffix ("-2", "-3", ...); one whose title
+    yields no id at all is named after its kind.
+    """
+    taken = set()
+    children = (
+        [(name, name.alias, "name") for name in place.names]
+        + [(location, location.title, "location") for location in place.locations]
+        + [(cnxn, cnxn.target, "connection") for cnxn in place.connections]
+    )
+    for record, title, kind in children:
+        base = make_object_id(title) or kind
+        new_id = base
+        n = 1
+        while new_id in taken:
+            n += 1
+            new_id = f"{base}-{n}"
+        if new_id != base:
+            logger.info(f'{place.title}: {kind} id "{base}" is taken; using "{new_id}".')
+        taken.add(new_id)
+        record.id = new_id
+
+
+def build_connection_graph(places):
+    """
+    Map each place title to the titles of the places in this import it connects to
+    """
+    graph = {}
     for title, place in places.items():
-        place["connections"] = build_connections(features_by_title[title], places)
-    return [place for title, place in places.items()]
+        targets = []
+        for connection in place.connections:
+            target = connection.target
+            if target in places and target not in targets:
+                targets.append(target)
+        graph[title] = targets
+    return graph
+
+
+def order_places(graph):
+    """
+    Order titles so that connection targets precede the places connecting to them
+
+    Uses an iterative version of Tarjan's strongly connected components
+    algorithm, which emits each component only after every component it can
+    reach. Returns the ordered titles and the set of titles that are members
+    of a connection cycle. Ties are broken by input order.
+    """
+    position = {title: i for i, title in enumerate(graph)}
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    ordered = []
+    cyclic = set()
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if target not in index:
+                    index[target] = lowlink[target] = len(index)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(graph[target])))
+                    break
+                elif target in on_stack:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in graph[node]:
+                        cyclic.update(component)
+                    ordered.extend(sorted(component, key=position.get))
+    return ordered, cyclic
+
+
+def open_output(fn):
+    if fn == "-":
+        return open(sys.stdout.fileno(), "w", encoding="utf-8", closefd=False)
+    return open(fn, "w", encoding="utf-8")
 
 
 def write_pjson(pjson, fn):
+    # serialize one place at a time; the output matches json.dump(indent=4)
+    with open_output(fn) as f:
+        f.write("[")
+        for i, place in enumerate(pjson):
+            text = json.dumps(place.to_dict(), ensure_ascii=False, indent=4, sort_keys=True)
+            f.write(",\n    " if i else "\n    ")
+            f.write(text.replace("\n", "\n    "))
+        f.write("\n]" if pjson else "]")
+
+
+def digest_place(place):
+    """
+    Return a SHA-256 hex digest of the canonical serialization of a place
+    """
+    canonical = json.dumps(
+        place, ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def digest_path(fn):
+    return os.path.splitext(fn)[0] + ".digests.json"
+
+
+def write_ndjson(places, fn, digests=None):
+    """
+    Write places as NDJSON, one line each, as they are produced
+
+    Each line is flushed at once, so a reader at the other end of a pipe
+    gets every place as soon as it is ready, and a slow reader holds the
+    writer back. If a digests dictionary is given, the digest of each place
+    is added to it, by title.
+    """
+    with open_output(fn) as f:
+        for place in places:
+            d = place.to_dict()
+            if digests is not None:
+                digests[place.title] = digest_place(d)
+            f.write(json.dumps(d, ensure_ascii=False, sort_keys=True) + "\n")
+            f.flush()
+
+
+def write_digests(digests, fn):
     with open(fn, "w", encoding="utf-8") as f:
-        json.dump(pjson, f, ensure_ascii=False, indent=4)
+        json.dump(digests, f, ensure_ascii=False, indent=4, sort_keys=True)
+
+
+def error_report_path(fn):
+    return os.path.splitext(fn)[0] + ".errors.json"
+
+
+def write_error_report(report, fn):
+    with open(fn, "w", encoding="utf-8") as f:
+        json.dump(report.to_dict(), f, ensure_ascii=False, indent=4)
+    if report.entries:
+        logger.warning(
+            f"{report.quarantined} rows quarantined; errors by category: "
+            f"{dict(sorted(report.counts.items()))} (see {fn})"
+        )
 
 
 def main(**kwargs):
@@ -769,11 +1551,24 @@ def main(**kwargs):
     fault_tolerant = kwargs["fault_tolerant"]
 
     # read CSV
-    in_data = read_ydea(kwargs["infile"])
+    in_data = read_ydea(kwargs["infile"], kwargs["processes"])
 
-    pjson = make_pjson(in_data)
+    # side files go next to the input when the output is standard output
+    outfile = kwargs["outfile"]
+    side_fn = kwargs["infile"] if outfile == "-" else outfile
 
-    write_pjson(pjson, kwargs["outfile"])
+    if kwargs["stream"]:
+        digests = {} if kwargs["emit_digest"] else None
+        write_ndjson(stream_places(in_data), outfile, digests)
+    else:
+        pjson = make_pjson(in_data)
+        write_pjson(pjson, outfile)
+        if kwargs["emit_digest"]:
+            digests = {place.title: digest_place(place.to_dict()) for place in pjson}
+    if kwargs["emit_digest"]:
+        write_digests(digests, digest_path(side_fn))
+    if fault_tolerant:
+        write_error_report(errors, error_report_path(side_fn))
 
     pass
 
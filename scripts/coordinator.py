@@ -0,0 +1,165 @@
+from __future__ import print_function
+
+import argparse
+from collections import OrderedDict
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+
+from placestream import iter_places
+
+
+LOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loader.py')
+
+
+def partition(count, n):
+    """Return the sizes of up to n contiguous partitions of count places."""
+    # contiguous slices keep the converter's connection order within each
+    # partition, so most connections can still be made immediately
+    size = max(1, -(-count // n))
+    return [min(size, count - i) for i in range(0, count, size)]
+
+
+def count_places(path):
+    with open(path) as f:
+        return sum(1 for place in iter_places(f))
+
+
+def write_partitions(path, sizes, part_paths):
+    """Split an import into NDJSON partitions of the given sizes."""
+    with open(path) as f:
+        places = iter_places(f)
+        for size, part_path in zip(sizes, part_paths):
+            tmp_path = part_path + '.tmp'
+            with open(tmp_path, 'w') as out:
+                for place in itertools.islice(places, size):
+                    out.write(json.dumps(place) + '\n')
+            os.rename(tmp_path, part_path)
+
+
+def read_confirmed(path):
+    """Return the confirmed batch entries of a loader journal, in order."""
+    pending = OrderedDict()
+    confirmed = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'committed' in entry:
+                confirmed.append(pending.pop(entry['committed']))
+            elif 'aborted' in entry:
+                pending.pop(entry['aborted'])
+            else:
+                pending[entry['batch']] = entry
+    if pending:
+        raise RuntimeError(
+            'Journal {} has unconfirmed batches; rerun its worker to '
+            'recover them.'.format(path))
+    return confirmed
+
+
+def merge_journals(paths, merged_path):
+    """Combine the workers' journals into one journal for the connections."""
+    lines = []
+    titles = set()
+    batch = 0
+    for path in paths:
+        for entry in read_confirmed(path):
+            for title, place_id, deferred in entry['places']:
+                if title in titles:
+                    raise RuntimeError(
+                        'Place "{}" was loaded by more than one '
+                        'worker.'.format(title))
+                titles.add(title)
+            batch += 1
+            entry['batch'] = batch
+            lines.append(json.dumps(entry))
+            lines.append(json.dumps({'committed': batch}))
+    tmp_path = merged_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
+    os.rename(tmp_path, merged_path)
+    return len(titles)
+
+
+def run_workers(commands, workdir):
+    """Start one process per command and wait for all of them."""
+    procs = []
+    for i, command in enumerate(commands):
+        log_path = os.path.join(workdir, 'worker-{}.log'.format(i))
+        log = open(log_path, 'a')
+        print('Starting worker {}: {}'.format(i, ' '.join(command)))
+        procs.append((i, subprocess.Popen(
+            command, stdout=log, stderr=subprocess.STDOUT), log, log_path))
+    failed = []
+    for i, proc, log, log_path in procs:
+        proc.wait()
+        log.close()
+        if proc.returncode != 0:
+            failed.append(log_path)
+    if failed:
+        raise RuntimeError(
+            'Workers failed; rerun to resume them. See: {}'.format(
+                ', '.join(failed)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load new Pleiades places in parallel across several '
+        'Zope (ZEO) clients. Options after "--" are passed on to loader.py, '
+        'e.g. -- --owner admin --groups editors.')
+    parser.add_argument('--client', action='append', required=True,
+                        dest='clients',
+                        help='Command prefix for one worker client, e.g. '
+                        '"bin/instance1 run". Repeat for each client.')
+    parser.add_argument('--workdir', default=None, dest='workdir',
+                        help='Directory for partitions, journals and logs. '
+                        'Defaults to the import file path plus ".parts".')
+    parser.add_argument('--loader', default=LOADER, dest='loader',
+                        help='Path to loader.py.')
+    parser.add_argument('file', help='Path to JSON (array) or NDJSON import '
+                        'file')
+    argv = sys.argv[1:]
+    loader_args = []
+    if '--' in argv:
+        loader_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or args.file + '.parts'
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    clients = [shlex.split(client) for client in args.clients]
+    merged_journal = os.path.join(workdir, 'journal.jsonl')
+
+    if not os.path.exists(merged_journal):
+        # create places in parallel; a rerun resumes from the journals
+        sizes = partition(count_places(args.file), len(clients))
+        # NDJSON, so that each worker can stream its partition
+        part_paths = [os.path.join(workdir, 'part-{}.ndjson'.format(i))
+                      for i in range(len(sizes))]
+        if not all(os.path.exists(path) for path in part_paths):
+            write_partitions(args.file, sizes, part_paths)
+        commands = []
+        journals = []
+        for i, (client, part_path) in enumerate(zip(clients, part_paths)):
+            journal = os.path.join(workdir, 'journal-{}.jsonl'.format(i))
+            journals.append(journal)
+            commands.append(client + [
+                args.loader, '--phase', 'places', '--journal', journal,
+                '--nolist'] + loader_args + [part_path])
+        run_workers(commands, workdir)
+        count = merge_journals(journals, merged_journal)
+        print('{} places loaded by {} workers.'.format(count, len(commands)))
+
+    # connect places once all of them exist, in a single client
+    command = clients[0] + [
+        args.loader, '--phase', 'connections', '--journal',
+        merged_journal] + loader_args + [args.file]
+    print('Creating deferred connections: {}'.format(' '.join(command)))
+    sys.stdout.flush()
+    sys.exit(subprocess.call(command))
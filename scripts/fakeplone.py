@@ -0,0 +1,557 @@
+from __future__ import print_function
+
+from collections import Counter, OrderedDict
+import fcntl
+import itertools
+import os
+import pickle
+import runpy
+import sys
+import time
+import types
+
+
+# field names per content type, as far as loader.py needs them
+SCHEMAS = {
+    'Place': [
+        'title', 'description', 'placeType', 'referenceCitations',
+        'creators', 'contributors', 'subject'],
+    'Name': [
+        'title', 'description', 'nameLanguage', 'nameTransliterated',
+        'nameAttested', 'nameType', 'attestations', 'referenceCitations',
+        'creators', 'contributors', 'subject'],
+    'Location': [
+        'title', 'description', 'geometry', 'archaeologicalRemains',
+        'accuracy', 'attestations', 'featureType', 'referenceCitations',
+        'creators', 'contributors', 'subject'],
+    'Connection': [
+        'title', 'description', 'connection', 'relationshipType',
+        'attestations', 'referenceCitations', 'creators', 'contributors',
+        'subject'],
+    'Folder': ['title', 'description'],
+    'Document': ['title', 'description', 'text'],
+}
+ACCURACY_IDS = [
+    'dura-europos-block-l7-chen',
+    'dura-europos-walls-and-towers-baird-chen',
+    'dura-europos-james-chen',
+    'ydea-chen-nominal-5m',
+]
+EXISTING_PLACE_IDS = ['893990', '15685985']
+CATALOG_INDEXES = [
+    'Creator', 'Description', 'SearchableText', 'Subject', 'Title', 'UID',
+    'allowedRolesAndUsers', 'connectsWith', 'created', 'getId',
+    'getPlaceType', 'hasConnectionsWith', 'id', 'modified', 'path',
+    'portal_type', 'review_state', 'sortable_title',
+]
+
+
+class CallCounter(object):
+    """Count calls to the fake site by name and simulate their latency.
+
+    latency maps call names to seconds. Simulated time is always added up;
+    with sleep=True the process also really sleeps for it.
+    """
+
+    def __init__(self, latency=None, sleep=False):
+        self.counts = Counter()
+        self.latency = latency or {}
+        self.sleep = sleep
+        self.simulated = 0.0
+
+    def __call__(self, name):
+        self.counts[name] += 1
+        delay = self.latency.get(name, 0.0)
+        if delay:
+            self.simulated += delay
+            if self.sleep:
+                time.sleep(delay)
+
+    def reset(self):
+        self.counts.clear()
+        self.simulated = 0.0
+
+
+calls = CallCounter()
+
+
+class Schema(object):
+
+    def __init__(self, names):
+        self.names = list(names)
+
+    def keys(self):
+        return list(self.names)
+
+
+def content_class(type_name):
+    return type(type_name, (object,), {'schema': Schema(SCHEMAS[type_name])})
+
+
+class ConflictError(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ReferenceException(Exception):
+    pass
+
+
+class Field(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, instance):
+        calls('Field.get')
+        return instance.fields.get(self.name)
+
+    def set(self, instance, value):
+        calls('Field.set')
+        instance.fields[self.name] = value
+
+    def resize(self, size, instance):
+        calls('Field.resize')
+
+
+class Content(object):
+    """A folderish Archetypes-like object with a fixed schema.
+
+    Accessors named set<Field> are available for every field in the
+    content type's schema.
+    """
+
+    _uids = itertools.count(1)
+
+    def __init__(self, id, portal_type='Folder', **kwargs):
+        self.id = id
+        self.portal_type = portal_type
+        self.parent = None
+        self.children = OrderedDict()
+        self.fields = dict(kwargs)
+        self.uid = 'uid-{}'.format(next(Content._uids))
+        self.owner = None
+        self.local_roles = {}
+
+    def __getattr__(self, name):
+        if name.startswith('set') and name[3:4].isupper():
+            field_name = name[3].lower() + name[4:]
+            if field_name in SCHEMAS[self.portal_type]:
+                def mutator(value):
+                    calls(name)
+                    self.fields[field_name] = value
+                return mutator
+        raise AttributeError(name)
+
+    def getId(self):
+        return self.id
+
+    def UID(self):
+        calls('UID')
+        return self.uid
+
+    def getField(self, name):
+        calls('getField')
+        if name in SCHEMAS[self.portal_type]:
+            return Field(name)
+        return None
+
+    def getPhysicalPath(self):
+        path = []
+        obj = self
+        while obj is not None:
+            path.append(obj.id)
+            obj = obj.parent
+        return tuple(reversed(path))
+
+    def invokeFactory(self, type_name, id, **kwargs):
+        calls('invokeFactory')
+        if id in self.children:
+            raise BadRequest('The id "{}" is invalid - it is already in '
+                             'use.'.format(id))
+        obj = Content(id, type_name, **kwargs)
+        obj.parent = self
+        self.children[id] = obj
+        obj.indexObject()
+        return id
+
+    def __getitem__(self, id):
+        return self.children[id]
+
+    def objectIds(self):
+        calls('objectIds')
+        return list(self.children)
+
+    def hasObject(self, id):
+        calls('hasObject')
+        return id in self.children
+
+    def generateId(self, prefix=''):
+        calls('generateId')
+        i = len(self.children)
+        while '{}{}'.format(prefix, i) in self.children:
+            i += 1
+        return '{}{}'.format(prefix, i)
+
+    def restrictedTraverse(self, path):
+        calls('restrictedTraverse')
+        if isinstance(path, bytes):
+            path = path.decode('utf-8')
+        obj = self
+        for part in path.strip('/').split('/'):
+            obj = obj.children[part]
+        return obj
+
+    def unrestrictedTraverse(self, path):
+        calls('unrestrictedTraverse')
+        return self.restrictedTraverse(path)
+
+    def catalog(self):
+        obj = self
+        while obj.parent is not None:
+            obj = obj.parent
+        catalog = getattr(obj, 'portal_catalog', None)
+        return None if catalog is None else Wrapper(catalog)
+
+    def indexObject(self):
+        catalog = self.catalog()
+        if catalog is not None:
+            catalog.indexObject(self)
+
+    def reindexObject(self, idxs=None):
+        calls('reindexObject')
+        catalog = self.catalog()
+        if catalog is not None:
+            catalog.reindexObject(self, idxs or [])
+
+    def reindexObjectSecurity(self):
+        calls('reindexObjectSecurity')
+
+    def changeOwnership(self, user, recursive=False):
+        calls('changeOwnership')
+        self.owner = user
+
+    def manage_setLocalRoles(self, userid, roles):
+        calls('manage_setLocalRoles')
+        self.local_roles[userid] = list(roles)
+
+
+class User(object):
+
+    def __init__(self, id):
+        self.id = id
+
+    def getId(self):
+        return self.id
+
+
+class Member(object):
+
+    def __init__(self, id):
+        self.id = id
+
+    def getUser(self):
+        return User(self.id)
+
+
+class MembershipTool(object):
+
+    def getMemberById(self, id):
+        calls('getMemberById')
+        return Member(id)
+
+
+class Brain(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def getPath(self):
+        return self.path
+
+
+class CatalogTool(object):
+    """Record what is indexed, and answer path queries by traversal.
+
+    Each catalog_object() call is counted, and so is each index it writes,
+    as catalog.index_write.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.indexed = {}  # path -> set of index names written
+
+    def indexObject(self, obj):
+        self.catalog_object(obj, '/'.join(obj.getPhysicalPath()))
+
+    def reindexObject(self, obj, idxs=[], update_metadata=1, uid=None):
+        if uid is None:
+            uid = '/'.join(obj.getPhysicalPath())
+        self.catalog_object(obj, uid, idxs, update_metadata)
+
+    def catalog_object(self, obj, uid=None, idxs=None, update_metadata=1,
+                       pghandler=None):
+        calls('catalog_object')
+        if uid is None:
+            uid = '/'.join(obj.getPhysicalPath())
+        written = idxs or CATALOG_INDEXES
+        for idx in written:
+            calls('catalog.index_write')
+        self.indexed.setdefault(uid, set()).update(written)
+
+    def unrestrictedSearchResults(self, path=None, **kwargs):
+        calls('unrestrictedSearchResults')
+        root = '/'.join(self.site.getPhysicalPath()) + '/'
+        brains = []
+        for query in path['query']:
+            obj = self.site
+            try:
+                for part in query[len(root):].split('/'):
+                    obj = obj.children[part]
+            except KeyError:
+                continue
+            brains.append(Brain(query))
+        return brains
+
+    searchResults = unrestrictedSearchResults
+    __call__ = unrestrictedSearchResults
+
+
+class Wrapper(object):
+    """Acquisition wrapper stand-in.
+
+    Like an implicit Acquisition wrapper, a new one is made for every
+    lookup of a tool, and methods found on the wrapped object's class are
+    bound to the wrapper rather than to the object. aq_base() unwraps it.
+    """
+
+    def __init__(self, obj):
+        self.__dict__['aq_base'] = obj
+
+    def __getattr__(self, name):
+        obj = self.__dict__['aq_base']
+        for klass in type(obj).__mro__:
+            if name in klass.__dict__:
+                attr = klass.__dict__[name]
+                if isinstance(attr, types.FunctionType):
+                    return types.MethodType(attr, self)
+                break
+        return getattr(obj, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__dict__['aq_base'], name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self.__getattr__('__call__')(*args, **kwargs)
+
+
+def aq_base(obj):
+    if isinstance(obj, Wrapper):
+        return obj.__dict__['aq_base']
+    return obj
+
+
+class PickleCache(object):
+
+    def __init__(self, site):
+        self.site = site
+
+    def __len__(self):
+        count = 0
+        stack = [self.site]
+        while stack:
+            obj = stack.pop()
+            count += 1
+            stack.extend(obj.children.values())
+        return count
+
+    @property
+    def cache_non_ghost_count(self):
+        return len(self)
+
+
+class Jar(object):
+    """ZODB connection stand-in: traversals count as loads from storage
+    and created objects as stores."""
+
+    def __init__(self, site):
+        self._cache = PickleCache(site)
+        self.cleared = Counter()
+
+    def getTransferCounts(self, clear=False):
+        counts = calls.counts - self.cleared
+        loads = counts['restrictedTraverse'] + counts['objectIds']
+        stores = counts['invokeFactory']
+        if clear:
+            self.cleared = Counter(calls.counts)
+        return loads, stores
+
+
+class Site(Content):
+
+    def __init__(self, id='plone'):
+        Content.__init__(self, id)
+        self._p_jar = Jar(self)
+        self.portal_membership = MembershipTool()
+        self.portal_catalog = CatalogTool(self)
+        self.portal_workflow = None
+
+
+def make_site():
+    """Return a site with a places folder and the accuracy documents."""
+    site = Site()
+    site.invokeFactory('Folder', 'places')
+    site.invokeFactory('Folder', 'features')
+    site['features'].invokeFactory('Folder', 'metadata')
+    for accuracy_id in ACCURACY_IDS:
+        site['features']['metadata'].invokeFactory('Document', accuracy_id)
+    for place_id in EXISTING_PLACE_IDS:
+        site['places'].invokeFactory('Place', place_id)
+    calls.reset()
+    return site
+
+
+class TransactionManager(object):
+    """Count commits and aborts, and optionally persist to a state file.
+
+    With a state file, commit() pickles the site to it and abort() puts the
+    last committed folder contents back. Without one, abort() does not roll
+    back anything. Commits whose number is in conflicts raise ConflictError.
+    """
+
+    def __init__(self, site, state=None, conflicts=()):
+        self.site = site
+        self.state = state
+        self.conflicts = set(conflicts)
+        self.commits = 0
+
+    def get(self):
+        return self
+
+    def note(self, text):
+        calls('transaction.note')
+
+    def commit(self):
+        calls('transaction.commit')
+        self.commits += 1
+        if self.commits in self.conflicts:
+            raise ConflictError(
+                'simulated conflict at commit {}'.format(self.commits))
+        if self.state is not None:
+            tmp_path = self.state + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self.site, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.state)
+
+    def abort(self):
+        calls('transaction.abort')
+        if self.state is None or not os.path.exists(self.state):
+            return
+        with open(self.state, 'rb') as f:
+            committed = pickle.load(f)
+        # keep the existing folder objects, as ZODB does after an abort
+        for id, folder in self.site.children.items():
+            folder.children = committed.children[id].children
+            for child in folder.children.values():
+                child.parent = folder
+
+    def savepoint(self, optimistic=False):
+        calls('transaction.savepoint')
+        return Savepoint(self.site)
+
+
+class Savepoint(object):
+    """Restores the contents of the site's top-level folders on rollback."""
+
+    def __init__(self, site):
+        self.folders = [(folder, OrderedDict(folder.children))
+                        for folder in site.children.values()]
+
+    def rollback(self):
+        calls('Savepoint.rollback')
+        for folder, children in self.folders:
+            folder.children = OrderedDict(children)
+
+
+def module(name, **attrs):
+    m = types.ModuleType(name)
+    m.__dict__.update(attrs)
+    sys.modules[name] = m
+    return m
+
+
+def install(site=None, state=None, conflicts=()):
+    """Register fake Zope/Plone modules so that loader.py can be imported.
+
+    Returns the site that pleiades.dump.getSite() will hand to the loader.
+    """
+    if site is None:
+        site = make_site()
+    txn = TransactionManager(site, state, conflicts)
+    module('Acquisition', aq_base=aq_base,
+           aq_parent=lambda obj: obj.parent)
+    module('pleiades')
+    module('pleiades.dump', getSite=lambda app: site,
+           spoofRequest=lambda app: app)
+    for name in ['Products', 'Products.Archetypes', 'Products.CMFCore',
+                 'Products.CMFPlone', 'Products.PleiadesEntity',
+                 'Products.PleiadesEntity.content']:
+        module(name)
+    module('Products.Archetypes.exceptions',
+           ReferenceException=ReferenceException)
+    module('Products.CMFCore.utils',
+           getToolByName=lambda context, name: Wrapper(getattr(site, name)))
+    module('Products.CMFPlone.utils', safe_unicode=lambda value: value)
+    module('Products.PleiadesEntity.content.interfaces', IWork=None)
+    for type_name in ['Connection', 'Location', 'Name', 'Place']:
+        module('Products.PleiadesEntity.content.' + type_name,
+               **{type_name: content_class(type_name)})
+    module('Products.validation', validation=None)
+    module('ZODB')
+    module('ZODB.POSException', ConflictError=ConflictError)
+    module('transaction', get=txn.get, commit=txn.commit, abort=txn.abort,
+           savepoint=txn.savepoint, manager=txn)
+    return site
+
+
+def main(argv):
+    """Run a script (normally loader.py) against a fake site.
+
+    Usage: fakeplone.py [--state FILE] SCRIPT [SCRIPT ARGS]
+
+    With --state, the site is loaded from and committed to FILE, and runs
+    sharing the file take turns through a lock on FILE.lock. That makes the
+    runner usable as a coordinator.py --client stand-in.
+    """
+    state = None
+    if argv[:1] == ['--state']:
+        state = os.path.abspath(argv[1])
+        argv = argv[2:]
+    script = argv[0]
+    lock = None
+    site = None
+    if state is not None:
+        lock = open(state + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(state):
+            with open(state, 'rb') as f:
+                site = pickle.load(f)
+    install(site, state)
+    sys.argv = argv
+    try:
+        runpy.run_path(script, init_globals={'app': None},
+                       run_name='__main__')
+    finally:
+        print(dict(calls.counts), file=sys.stderr)
+        if lock is not None:
+            lock.close()
+
+
+if __name__ == '__main__':
+    # import ourselves so that pickled state refers to fakeplone.*
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import fakeplone
+    fakeplone.main(sys.argv[1:])
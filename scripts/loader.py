@@ -1,19 +1,32 @@
 from __future__ import print_function
 
-from Acquisition import aq_parent
+from Acquisition import aq_base, aq_parent
 import argparse
+from collections import Counter, OrderedDict
+import functools
 import json
+import os
 from pleiades.dump import getSite, spoofRequest
 from pprint import pprint
 from Products.Archetypes.exceptions import ReferenceException
 from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.utils import safe_unicode
+from Products.PleiadesEntity.content.Connection import Connection
+from Products.PleiadesEntity.content.Location import Location
+from Products.PleiadesEntity.content.Name import Name
+from Products.PleiadesEntity.content.Place import Place
 from Products.PleiadesEntity.content.interfaces import IWork
 from Products.validation import validation
+import random
 import re
 import string
 import sys
+import time
 import transaction
+from ZODB.POSException import ConflictError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from placestream import iter_places
 
 
 RX_SPACE = re.compile(r'[^\w\s]')
@@ -21,6 +34,548 @@ RX_UNDERSCORE = re.compile(r'\_')
 FALLBACK_IDS = {
     'City wall of Dura-Europos': '15685985'  # production
 }
+BATCH_OBJECTS = 600  # initial objects per transaction
+MIN_BATCH_OBJECTS = 20
+MAX_BATCH_OBJECTS = 20000
+RETRY_BACKOFF = 0.5  # seconds; doubled after each conflict
+PHASES = ['places', 'names', 'locations', 'connections', 'ownership',
+          'indexing', 'commit']
+CONTENT_CLASSES = {
+    'Connection': Connection,
+    'Location': Location,
+    'Name': Name,
+    'Place': Place,
+}
+# place keys that are created as child objects rather than set as fields
+PLACE_CHILD_KEYS = ['locations', 'names', 'connections', 'connectionCycle']
+# catalog indexes of a place that change when another place connects to it
+INCOMING_CONNECTION_INDEXES = ['hasConnectionsWith']
+
+
+
+class LoadStats(object):
+    """Timings and counters for one run of the loader.
+
+    Time is charged to one phase at a time: entering a phase from inside
+    another pauses the outer one, so the phases add up to the time spent
+    loading. Each commit records the objects created in its transaction and
+    how long the commit took, and samples the ZODB connection's transfer
+    counts and cache.
+    """
+
+    def __init__(self, site, interval=None):
+        self.site = site
+        self.interval = interval
+        self.started = self.last_progress = self.mark = time.time()
+        self.phases = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.stack = []
+        self.totals = Counter()  # objects created, by kind, in commits
+        self.batch = Counter()  # objects created in this transaction
+        self.indexed = 0  # catalog writes deferred to commit time
+        self.batch_indexed = 0  # and those made in this transaction
+        self.transactions = []
+        self.conflicts = 0
+        self.retries = 0
+        self.rollbacks = 0
+        self.skipped = 0  # connections a dry run could only check
+        self.backoff = 0.0
+        self.zodb = None
+        self.jar = getattr(site, '_p_jar', None)
+        if self.jar is not None:
+            self.jar.getTransferCounts(clear=True)
+
+    def start(self, phase):
+        now = time.time()
+        if self.stack:
+            self.phases[self.stack[-1]] += now - self.mark
+        self.stack.append(phase)
+        self.mark = now
+
+    def stop(self):
+        now = time.time()
+        self.phases[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    @property
+    def places(self):
+        return self.totals['place'] + self.batch['place']
+
+    @property
+    def connections(self):
+        return self.totals['connection'] + self.batch['connection']
+
+    def created(self, kind):
+        self.batch[kind] += 1
+
+    def wrote_index(self):
+        # not an object: kept out of batch_objects() and the sizer's rate
+        self.batch_indexed += 1
+
+    def committed(self, seconds):
+        self.transactions.append({
+            'objects': sum(self.batch.values()),
+            'indexed': self.batch_indexed,
+            'seconds': round(seconds, 4)})
+        self.totals.update(self.batch)
+        self.batch.clear()
+        self.indexed += self.batch_indexed
+        self.batch_indexed = 0
+        self.sample_zodb()
+
+    def batch_objects(self):
+        return sum(self.batch.values())
+
+    def aborted(self):
+        self.batch.clear()
+        self.batch_indexed = 0
+
+    def rolled_back(self):
+        # a dry run's batch still counts as work done
+        self.totals.update(self.batch)
+        self.batch.clear()
+        self.indexed += self.batch_indexed
+        self.batch_indexed = 0
+        self.rollbacks += 1
+
+    def conflicted(self, delay):
+        self.conflicts += 1
+        self.retries += 1
+        self.backoff += delay
+
+    def sample_zodb(self):
+        if self.jar is None:
+            return
+        loads, stores = self.jar.getTransferCounts()
+        cache = self.jar._cache
+        self.zodb = OrderedDict([
+            ('loads', loads),  # objects read from storage: cache misses
+            ('stores', stores),
+            ('cache_size', len(cache)),
+            ('cache_non_ghost_count', cache.cache_non_ghost_count),
+            ('note', 'loads are cache misses; ZODB does not count cache '
+                     'hits, so there is no hit rate.'),
+        ])
+
+    def progress(self, force=False):
+        now = time.time()
+        if not force and (
+                self.interval is None or
+                now - self.last_progress < self.interval):
+            return
+        self.last_progress = now
+        elapsed = now - self.started
+        line = '[{:.0f}s] {} places ({:.1f}/s), {} connections, {} ' \
+            'transactions'.format(
+                elapsed, self.places, self.places / max(elapsed, 1e-9),
+                self.connections, len(self.transactions))
+        if self.transactions:
+            line += ', last commit {:.2f}s'.format(
+                self.transactions[-1]['seconds'])
+        if self.conflicts:
+            line += ', {} conflicts'.format(self.conflicts)
+        if self.skipped:
+            line += ', {} connections skipped'.format(self.skipped)
+        print(line)
+        sys.stdout.flush()
+
+    def to_dict(self):
+        elapsed = time.time() - self.started
+        commits = [t['seconds'] for t in self.transactions]
+        objects = [t['objects'] for t in self.transactions]
+        return OrderedDict([
+            ('elapsed_seconds', round(elapsed, 3)),
+            ('places', self.places),
+            ('places_per_second', round(self.places / max(elapsed, 1e-9), 2)),
+            ('connections', self.connections),
+            ('deferred_index_writes', self.indexed + self.batch_indexed),
+            ('phase_seconds', OrderedDict(
+                (phase, round(seconds, 3))
+                for phase, seconds in self.phases.items())),
+            ('commits', OrderedDict([
+                ('count', len(commits)),
+                ('total_seconds', round(sum(commits), 3)),
+                ('max_seconds', max(commits) if commits else 0),
+                ('mean_objects', round(
+                    sum(objects) / float(len(objects)), 1)
+                    if objects else 0),
+                ('max_objects', max(objects) if objects else 0),
+            ])),
+            ('transactions', self.transactions),
+            ('conflicts', self.conflicts),
+            ('retries', self.retries),
+            ('backoff_seconds', round(self.backoff, 3)),
+            ('rollbacks', self.rollbacks),
+            ('skipped_connections', self.skipped),
+            ('zodb', self.zodb),
+        ])
+
+
+def timed(phase):
+    """Charge the time spent in the decorated function to a phase."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats.start(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.stop()
+        return wrapper
+    return decorate
+
+
+class TransactionSizer(object):
+    """Decide how many objects go into each transaction.
+
+    After each commit the budget moves halfway toward the object count that
+    would have taken target seconds to commit at the measured rate, within
+    MIN_BATCH_OBJECTS and MAX_BATCH_OBJECTS. A conflict halves it. With no
+    target the budget stays fixed.
+    """
+
+    def __init__(self, budget=BATCH_OBJECTS, target=None):
+        self.budget = budget
+        self.target = target
+
+    def full(self, objects):
+        return objects >= self.budget
+
+    def committed(self, objects, seconds):
+        if not self.target or not objects or seconds <= 0:
+            return
+        ideal = objects * self.target / seconds
+        self.set_budget((self.budget + ideal) / 2)
+
+    def conflicted(self):
+        if self.target:
+            self.set_budget(self.budget / 2)
+
+    def set_budget(self, budget):
+        self.budget = int(
+            min(MAX_BATCH_OBJECTS, max(MIN_BATCH_OBJECTS, budget)))
+
+
+class BatchSavepoints(object):
+    """Savepoints within one transaction batch.
+
+    An optimistic savepoint every `every` objects lets ZODB move the
+    batch's changes out of the object cache, capping memory use. In a dry
+    run, each batch also starts with a savepoint that rollback() returns
+    to, instead of the whole run piling up in one transaction.
+    """
+
+    def __init__(self, every, dry_run):
+        self.every = every
+        self.dry_run = dry_run
+        self.start = None
+        self.mark = 0
+
+    def begin(self):
+        self.mark = 0
+        if self.dry_run:
+            self.start = transaction.savepoint()
+
+    def check(self, objects):
+        if self.every and objects - self.mark >= self.every:
+            transaction.savepoint(optimistic=True)
+            self.mark = objects
+
+    def rollback(self):
+        self.start.rollback()
+        self.start = None
+
+
+class ReindexQueue(object):
+    """Record which objects need reindexing and reindex each one once.
+
+    Objects are keyed by physical path. A mark without idxs asks for a full
+    reindex, which absorbs any partial ones; partial marks merge their
+    index names. Call flush() before each transaction commit.
+    """
+
+    def __init__(self):
+        self.pending = OrderedDict()
+
+    def mark(self, obj, idxs=None):
+        key = obj.getPhysicalPath()
+        try:
+            entry = self.pending[key]
+        except KeyError:
+            self.pending[key] = [obj, None if idxs is None else set(idxs)]
+        else:
+            if entry[1] is not None:
+                if idxs is None:
+                    entry[1] = None
+                else:
+                    entry[1].update(idxs)
+
+    def flush(self):
+        for obj, idxs in self.pending.values():
+            if idxs is None:
+                obj.reindexObject()
+            else:
+                obj.reindexObject(idxs=sorted(idxs))
+        self.clear()
+
+    def clear(self):
+        self.pending.clear()
+
+
+class DeferredIndexing(object):
+    """Hold back catalog indexing and replay it in bulk.
+
+    While installed, calls to catalog_object() on the site's catalog (made
+    by indexObject and reindexObject) are recorded instead of indexing, and
+    flush() then indexes each object once, with the union of the index
+    names asked for. The patch is made on the catalog class, and calls
+    are told apart by the unwrapped catalog, since each lookup of the tool
+    hands out a new Acquisition wrapper. Everything recorded belongs to the
+    current transaction: flush() before it commits, discard() if it is
+    aborted.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.cls = type(aq_base(catalog))
+        self.own = self.cls.__dict__.get('catalog_object')
+        # the plain function, so that it can be called on a wrapper
+        self.original = getattr(self.cls.catalog_object, '__func__',
+                                self.cls.catalog_object)
+        self.pending = OrderedDict()
+
+    def install(self):
+        deferral = self
+
+        def catalog_object(catalog, obj, uid=None, idxs=None,
+                           update_metadata=1, pghandler=None):
+            if aq_base(catalog) is not aq_base(deferral.catalog):
+                return deferral.original(
+                    catalog, obj, uid, idxs, update_metadata, pghandler)
+            deferral.record(obj, uid, idxs, update_metadata)
+
+        self.cls.catalog_object = catalog_object
+
+    def uninstall(self):
+        if self.own is None:
+            del self.cls.catalog_object
+        else:
+            self.cls.catalog_object = self.own
+
+    def record(self, obj, uid, idxs, update_metadata):
+        key = uid or '/'.join(obj.getPhysicalPath())
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [
+                obj, uid, set(idxs) if idxs else None, update_metadata]
+            return
+        if not idxs:
+            entry[2] = None
+        elif entry[2] is not None:
+            entry[2].update(idxs)
+        entry[3] = entry[3] or update_metadata
+
+    @timed('indexing')
+    def index(self, entry):
+        obj, uid, idxs, update_metadata = entry
+        stats.wrote_index()
+        self.original(self.catalog, obj, uid,
+                      None if idxs is None else sorted(idxs), update_metadata)
+
+    def flush(self):
+        entries = list(self.pending.values())
+        self.pending.clear()
+        for entry in entries:
+            self.index(entry)
+
+    def discard(self):
+        self.pending.clear()
+
+
+class TraversalCache(object):
+    """Cache of traversed objects and their UIDs, keyed by path.
+
+    Paths are relative to the site, as given to restrictedTraverse. Entries
+    last for the run, except that commit_batch() forgets the places.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.objects = {}
+        self.uids = {}
+
+    def add(self, path, obj):
+        self.objects[path] = obj
+
+    def clear(self):
+        self.objects.clear()
+        self.uids.clear()
+
+    def forget(self, prefix, keep=()):
+        """Forget the paths under prefix, except those in keep."""
+        for cache in [self.objects, self.uids]:
+            for path in [p for p in cache
+                         if p.startswith(prefix) and p not in keep]:
+                del cache[path]
+
+    def get(self, path):
+        try:
+            return self.objects[path]
+        except KeyError:
+            obj = self.site.restrictedTraverse(path.encode('utf-8'))
+            self.objects[path] = obj
+            return obj
+
+    def uid(self, path):
+        try:
+            return self.uids[path]
+        except KeyError:
+            uid = self.get(path).UID()
+            self.uids[path] = uid
+            return uid
+
+
+class IdRegistry(object):
+    """In-memory record of the ids in use in each container.
+
+    A container's ids are read with objectIds() the first time it is seen
+    (or not at all, for containers this run created) and kept up to date
+    with add() afterwards. The containers are places, so the registry is
+    cleared after each commit.
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def ids_in(self, container):
+        key = container.getPhysicalPath()
+        try:
+            return self.ids[key]
+        except KeyError:
+            ids = set(container.objectIds())
+            self.ids[key] = ids
+            return ids
+
+    def created(self, container):
+        self.ids[container.getPhysicalPath()] = set()
+
+    def clear(self):
+        self.ids.clear()
+
+    def contains(self, container, id):
+        return id in self.ids_in(container)
+
+    def add(self, container, id):
+        self.ids_in(container).add(id)
+
+
+class Journal(object):
+    """Local, append-only record of committed work, for resuming a load.
+
+    Each transaction batch appends a line listing the places it created
+    (title, Pleiades id, and whether their connections were deferred) and
+    the places whose deferred connections it completed. The line is written
+    just before the transaction commits; a second line confirms the commit.
+    A batch left unconfirmed by a crash is checked against Plone by
+    recover(). With no path, the journal is kept in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.ids = OrderedDict()
+        self.deferred = set()
+        self.connected = set()
+        self.verify = set()
+        self.unconfirmed = []
+        self.batch = 0
+        self.prepared = False
+        self.places = []
+        self.connections = []
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        batches = OrderedDict()
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'committed' in entry:
+                    self.confirm(batches.pop(entry['committed']))
+                elif 'aborted' in entry:
+                    batches.pop(entry['aborted'])
+                else:
+                    batches[entry['batch']] = entry
+                    self.batch = max(self.batch, entry['batch'])
+        self.unconfirmed = list(batches.values())
+
+    def confirm(self, entry):
+        for title, place_id, deferred in entry['places']:
+            self.ids[title] = place_id
+            if deferred:
+                self.deferred.add(place_id)
+        self.connected.update(entry['connections'])
+
+    def recover(self, places_folder):
+        """Settle batches whose commit was never confirmed.
+
+        A batch that created places committed if its first place exists.
+        For a batch that only created connections, the places involved are
+        flagged so that connections found to exist already are skipped.
+        """
+        for entry in self.unconfirmed:
+            if entry['places']:
+                if places_folder.hasObject(entry['places'][0][1]):
+                    self.confirm(entry)
+                    self.write({'committed': entry['batch']})
+                    continue
+            else:
+                self.verify.update(entry['connections'])
+            # the work is redone, and journaled again, in a new batch
+            self.write({'aborted': entry['batch']})
+        self.unconfirmed = []
+
+    def record_place(self, title, place_id, deferred):
+        self.places.append((title, place_id, deferred))
+
+    def record_connected(self, place_id):
+        self.connections.append(place_id)
+
+    def prepare(self):
+        """Write the current batch as pending; call just before commit."""
+        if not self.places and not self.connections:
+            return
+        self.batch += 1
+        self.prepared = True
+        self.write({
+            'batch': self.batch,
+            'places': self.places,
+            'connections': self.connections})
+
+    def commit(self):
+        """Confirm the current batch; call right after commit."""
+        if self.prepared:
+            self.write({'committed': self.batch})
+        self.confirm({'places': self.places, 'connections': self.connections})
+        self.prepared = False
+        self.places = []
+        self.connections = []
+
+    def abort(self):
+        """Drop the current batch; call after the transaction is aborted."""
+        if self.prepared:
+            self.write({'aborted': self.batch})
+        self.prepared = False
+        self.places = []
+        self.connections = []
+
+    def write(self, entry):
+        if self.path is None:
+            return
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
 
 
 def make_name_id(name):
@@ -35,54 +590,63 @@ def make_name_id(name):
     return safe_unicode(this_id)
 
 
+@timed('names')
 def populate_names(place_data, plone_context, args):
     names = []
     for name in place_data['names']:
-        new_id = make_name_id(name['nameTransliterated'])
+        new_id = name.get('id') or make_name_id(name['nameTransliterated'])
         plone_context.invokeFactory(
             'Name',
             id=new_id,
             nameTransliterated=name['nameTransliterated'],
             title=name['nameTransliterated'])
+        id_registry.add(plone_context, new_id)
+        stats.created('name')
         name_obj = plone_context[new_id]
         for k, v in name.items():
-            if k in ['title']:
+            if k in ['title', 'id']:
                 continue
             populate_field(name_obj, k, v)
         set_attribution(name_obj, args)
+        set_ownership(name_obj)
 
 
+@timed('locations')
 def populate_locations(place_data, plone_context, args):
     dflt = ['title', 'geometry']
     for location in place_data['locations']:
-        new_id = make_name_id(location['title'])
+        new_id = location.get('id') or make_name_id(location['title'])
         plone_context.invokeFactory(
             'Location',
             id=new_id,
             title=location['title'],
             geometry=json.dumps(location['geometry'])
         )
+        id_registry.add(plone_context, new_id)
+        stats.created('location')
         location_obj = plone_context[new_id]
         for k, v in location.items():
-            if k in ['title', 'geometry']:
+            if k in ['title', 'geometry', 'id']:
                 continue
             elif k == 'accuracy':
                 val = v
                 if val.startswith('/'):
                     val = val[1:]
-                acc_obj = site.restrictedTraverse(val.encode('utf-8'))
-                location_obj.setAccuracy([acc_obj.UID()])
+                location_obj.setAccuracy([traversal_cache.uid(val)])
             else:
                 populate_field(location_obj, k, v)
         set_attribution(location_obj, args)
+        set_ownership(location_obj)
 
 
-def populate_field(content, k, v):
+def field_name(k):
     if k == 'references':
-        key = 'referenceCitations'
-    else:
-        key = k
-    field = content.getField(key)
+        return 'referenceCitations'
+    return k
+
+
+def populate_field(content, k, v):
+    field = content.getField(field_name(k))
     if field is None:
         raise RuntimeError(
             'content.getField() returned None for field '
@@ -109,6 +673,265 @@ def populate_field(content, k, v):
                 'Invalid reference on field "{}". Skipping.'.format(k))
 
 
+def connection_target(connection, loaded_ids):
+    """Return the id of a connection's target and the relationship type.
+
+    The id is None for a place that a dry run has rolled back. A target
+    that is neither loaded nor in FALLBACK_IDS raises KeyError.
+    """
+    target = connection['connection']
+    if target in rolled_back:
+        return None, connection['relationshipType']
+    try:
+        return loaded_ids[target], connection['relationshipType']
+    except KeyError:
+        return FALLBACK_IDS[target], 'part_of_physical'
+
+
+@timed('connections')
+def populate_connections(from_place, connections, loaded_ids, args):
+    for connection in connections:
+        to_id, rtype = connection_target(connection, loaded_ids)
+        cnxn_id = connection.get('id') or make_name_id(
+            connection['connection'])
+        if id_registry.contains(from_place, cnxn_id):
+            if from_place.getId() in journal.verify:
+                continue  # created by a batch whose commit went unconfirmed
+            raise RuntimeError(
+                'Connection id collision: {}'.format(cnxn_id))
+        if to_id is None:
+            # dry run: the target went with its batch's rollback, so the
+            # connection is only checked, and its id taken
+            id_registry.add(from_place, cnxn_id)
+            stats.skipped += 1
+            continue
+        to_path = 'places/' + to_id
+        to_place = traversal_cache.get(to_path)
+        from_place.invokeFactory('Connection', id=cnxn_id)
+        id_registry.add(from_place, cnxn_id)
+        stats.created('connection')
+        cnxn_obj = from_place[cnxn_id]
+        cnxn_obj.setConnection([traversal_cache.uid(to_path)])
+        cnxn_obj.setTitle(connection['connection'])
+        cnxn_obj.setRelationshipType(rtype)
+        set_attribution(cnxn_obj, args)
+        set_ownership(cnxn_obj)
+
+        reindex_queue.mark(to_place, idxs=INCOMING_CONNECTION_INDEXES)
+
+
+def check_connections(item, loaded_ids):
+    """Check the deferred connections of a place that a dry run rolled back.
+
+    They cannot be made, but their targets must be known and their ids
+    must not collide within the place.
+    """
+    title, connections = item
+    ids = set()
+    for connection in connections:
+        connection_target(connection, loaded_ids)
+        cnxn_id = connection.get('id') or make_name_id(
+            connection['connection'])
+        if cnxn_id in ids:
+            raise RuntimeError(
+                'Connection id collision: {}'.format(cnxn_id))
+        ids.add(cnxn_id)
+        stats.skipped += 1
+
+
+def can_connect(place, loaded_ids):
+    # the converter writes connection targets ahead of the places that
+    # connect to them, so only cycle members (or unordered input) wait
+    if place.get('connectionCycle', False):
+        return False
+    for connection in place['connections']:
+        target = connection['connection']
+        if target not in loaded_ids and target not in FALLBACK_IDS:
+            return False
+    return True
+
+
+@timed('places')
+def load_place(place, args):
+    """Create a place with its names, locations and connections.
+
+    Connections whose targets are not all loaded yet are left in
+    connections_pending. Places already in the journal are only registered.
+    """
+    try:
+        new_id = journal.ids[place['title']]
+    except KeyError:
+        pass
+    else:
+        loaded_ids[place['title']] = new_id
+        if new_id in journal.deferred and new_id not in journal.connected:
+            connections_pending[new_id] = place['connections']
+        return
+    if args.phase == 'connections':
+        raise RuntimeError(
+            'Place "{}" is not in the journal; run the places phase '
+            'first.'.format(place['title']))
+    new_id = places_folder.generateId(prefix='')
+    places_folder.invokeFactory(
+        'Place',
+        id=new_id,
+        title=place['title'])
+    stats.created('place')
+    loaded_ids[place['title']] = new_id
+    content = places_folder[new_id]
+    traversal_cache.add('places/' + new_id, content)
+    id_registry.created(content)
+    set_ownership(content)
+    set_local_roles(content, args)
+    for k, v in place.items():
+        if k in PLACE_CHILD_KEYS or k == 'title':
+            continue  # address these after the place is created in plone
+        populate_field(content, k, v)
+    set_attribution(content, args)
+    set_tags(content, args)
+
+    # create names
+    if len(place['names']) > 0:
+        populate_names(place, content, args)
+
+    # create locations
+    if len(place['locations']) > 0:
+        populate_locations(place, content, args)
+
+    # create connections now if every target is already in plone,
+    # otherwise store connection info to create later
+    deferred = False
+    if len(place['connections']) > 0:
+        if can_connect(place, loaded_ids):
+            populate_connections(
+                content, place['connections'], loaded_ids, args)
+        else:
+            connections_pending[new_id] = place['connections']
+            deferred = True
+    journal.record_place(place['title'], new_id, deferred)
+
+    reindex_queue.mark(content)
+
+
+def unload_place(place):
+    new_id = loaded_ids.pop(place['title'], None)
+    if new_id is not None:
+        connections_pending.pop(new_id, None)
+
+
+@timed('connections')
+def load_connections(item, args):
+    place_id, connections = item
+    from_place = traversal_cache.get('places/' + place_id)
+    populate_connections(from_place, connections, loaded_ids, args)
+    journal.record_connected(place_id)
+    reindex_queue.mark(from_place)
+
+
+def run_batches(items, work, undo, args):
+    """Apply work to items, committing whenever the transaction is full.
+
+    The sizer sets how many objects make a full transaction. A dry run
+    rolls each batch back instead of committing it.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        stats.progress()
+        if run_batch(batch, len(batch) - 1, work, undo, args):
+            batch = []
+    if batch:
+        run_batch(batch, len(batch), work, undo, args, commit=True)
+
+
+def run_batch(batch, start, work, undo, args, commit=False):
+    """Apply work to batch[start:], then commit the batch if it is full.
+
+    Returns whether the batch was committed. A batch that hits a
+    ConflictError is aborted, undone and replayed from its first item
+    after an exponentially growing, jittered delay, up to args.retries
+    times.
+    """
+    attempt = 0
+    while True:
+        try:
+            if start == 0:
+                savepoints.begin()
+            for item in batch[start:]:
+                work(item, args)
+                savepoints.check(stats.batch_objects())
+            if commit or sizer.full(stats.batch_objects()):
+                commit_batch(args)
+                return True
+            return False
+        except ConflictError:
+            attempt += 1
+            if attempt > args.retries:
+                raise
+            transaction.abort()
+            journal.abort()
+            stats.aborted()
+            reindex_queue.clear()
+            if deferred_indexing is not None:
+                deferred_indexing.discard()
+            traversal_cache.clear()
+            id_registry.clear()
+            for item in batch:
+                undo(item)
+            start = 0
+            delay = RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+            stats.conflicted(delay)
+            sizer.conflicted()
+            print('Conflict; retrying batch in {:.1f}s (attempt {})'.format(
+                delay, attempt))
+            time.sleep(delay)
+
+
+@timed('commit')
+def commit_batch(args):
+    reindex_queue.flush()
+    if deferred_indexing is not None:
+        deferred_indexing.flush()
+    if args.dry_run:
+        roll_back_batch()
+        return
+    journal.prepare()
+    objects = stats.batch_objects()
+    start = time.time()
+    transaction.commit()
+    seconds = time.time() - start
+    stats.committed(seconds)
+    sizer.committed(objects, seconds)
+    journal.commit()
+    # entries for the batch's own places are not needed again; the places
+    # folder, accuracy documents and fallback targets are
+    traversal_cache.forget('places/', keep=[
+        'places/' + place_id for place_id in FALLBACK_IDS.values()])
+    id_registry.clear()
+
+
+def roll_back_batch():
+    """Undo a dry run's batch, remembering the places that went with it.
+
+    Connections to those places are only checked from then on, and so are
+    their own deferred connections, which are set aside for that. The
+    places stay in loaded_ids for the dry run's report, although their ids
+    are free to be given out again.
+    """
+    savepoints.rollback()
+    for title, place_id, deferred in journal.places:
+        rolled_back.add(title)
+        connections = connections_pending.pop(place_id, None)
+        if connections is not None:
+            connections_unmade.append((title, connections))
+    journal.abort()
+    stats.rolled_back()
+    traversal_cache.clear()
+    id_registry.clear()
+    if deferred_indexing is not None:
+        deferred_indexing.discard()
+
+
 def set_attribution(content, args):
     if args.creators:
         populate_field(content, 'creators', args.creators)
@@ -118,15 +941,147 @@ def set_attribution(content, args):
         populate_field(content, 'contributors', args.contributors)
 
 
+@timed('ownership')
+def set_ownership(content):
+    content.changeOwnership(owner, recursive=False)
+
+
+@timed('ownership')
+def set_local_roles(content, args):
+    # set on the place before its children are created, so that they are
+    # catalogued with the inherited roles in the first place
+    content.manage_setLocalRoles(args.owner, ["Owner",])
+    for group in args.groups:
+        content.manage_setLocalRoles(
+            group, ['Reader', 'Editor', 'Contributor'])
+
+
 def set_tags(content, args):
     if args.subjects:
         populate_field(content, 'subject', args.subjects)
 
 
-if __name__ == '__main__':
+def preflight(places, plone_site, args):
+    """Check an import against the site without creating anything.
+
+    Field names are checked once per content type against the schemas,
+    accuracy paths and external connection targets are looked up in one
+    catalog query, and the ids each place's names, locations and
+    connections will get (from the import, or else from make_name_id())
+    are checked for collisions. Returns
+    the number of places checked and a list of problems.
+    """
+    problems = []
+    fields = OrderedDict()  # (content type, field name) -> first title
+    titles = set()
+    targets = OrderedDict()  # connection target -> first title
+    accuracy_paths = OrderedDict()  # site-relative path -> first title
+    count = 0
+    for place in places:
+        count += 1
+        title = place['title']
+        if title in titles:
+            problems.append('Place "{}" occurs more than once.'.format(title))
+        titles.add(title)
+        children = [('Place', place)]
+        children.extend(('Name', name) for name in place['names'])
+        children.extend(('Location', loc) for loc in place['locations'])
+        for type_name, data in children:
+            for k in data:
+                if k == 'id':
+                    continue  # given to invokeFactory
+                if type_name != 'Place' or k not in PLACE_CHILD_KEYS:
+                    fields.setdefault((type_name, field_name(k)), title)
+        if place['connections']:
+            for k in ['connection', 'title', 'relationshipType']:
+                fields.setdefault(('Connection', k), title)
+        for location in place['locations']:
+            path = location.get('accuracy')
+            if path is not None:
+                accuracy_paths.setdefault(path.lstrip('/'), title)
+        for connection in place['connections']:
+            targets.setdefault(connection['connection'], title)
+
+        # ids are allocated within the new place, so only clash there
+        ids = {}
+        for kind, data, value in (
+                [('name', n, n['nameTransliterated'])
+                 for n in place['names']] +
+                [('location', l, l['title']) for l in place['locations']] +
+                [('connection', c, c['connection'])
+                 for c in place['connections']]):
+            new_id = data.get('id') or make_name_id(value)
+            if not new_id:
+                problems.append(
+                    'Place "{}": {} "{}" gives an empty id.'.format(
+                        title, kind, value))
+            elif new_id in ids:
+                problems.append(
+                    'Place "{}": {} "{}" and {} "{}" both get id '
+                    '"{}".'.format(title, ids[new_id][0], ids[new_id][1],
+                                   kind, value, new_id))
+            else:
+                ids[new_id] = (kind, value)
+
+    # attribution fields are set on every new object
+    for type_name in CONTENT_CLASSES:
+        fields.setdefault((type_name, 'creators'), None)
+        if args.contributors:
+            fields.setdefault((type_name, 'contributors'), None)
+    if args.subjects:
+        fields.setdefault(('Place', 'subject'), None)
+    schemas = {}
+    for (type_name, key), title in fields.items():
+        if type_name not in schemas:
+            schemas[type_name] = set(CONTENT_CLASSES[type_name].schema.keys())
+        if key not in schemas[type_name]:
+            problems.append('{} has no field "{}"{}.'.format(
+                type_name, key,
+                '' if title is None else ' (first used by "{}")'.format(
+                    title)))
+
+    target_paths = OrderedDict()
+    for target, title in targets.items():
+        if target in titles:
+            continue
+        try:
+            target_paths['places/' + FALLBACK_IDS[target]] = (target, title)
+        except KeyError:
+            problems.append(
+                'Place "{}": connection target "{}" is neither in the import '
+                'nor in FALLBACK_IDS.'.format(title, target))
+    found = find_paths(
+        plone_site, list(accuracy_paths) + list(target_paths))
+    for path, title in accuracy_paths.items():
+        if path not in found:
+            problems.append('Place "{}": accuracy "/{}" not found.'.format(
+                title, path))
+    for path, (target, title) in target_paths.items():
+        if path not in found:
+            problems.append(
+                'Place "{}": connection target "{}" ({}) not found.'.format(
+                    title, target, path))
+    return count, problems
+
+
+def find_paths(plone_site, paths):
+    """Return the set of site-relative paths that exist, in one query."""
+    if not paths:
+        return set()
+    catalog = getToolByName(plone_site, 'portal_catalog')
+    root = '/'.join(plone_site.getPhysicalPath()) + '/'
+    brains = catalog.unrestrictedSearchResults(
+        path={'query': [root + path for path in paths], 'depth': 0})
+    return set(brain.getPath()[len(root):] for brain in brains)
+
+
+def make_parser():
     parser = argparse.ArgumentParser(description='Create new Pleiades places.')
     parser.add_argument('--dry-run', action='store_true', default=False,
                         dest='dry_run', help='No changes will be made.')
+    parser.add_argument('--preflight', action='store_true', default=False,
+                        dest='preflight', help='Only check the import against '
+                        'the site, without creating anything.')
     parser.add_argument('--nolist', action='store_true', default=False,
                         dest='nolist', help='Do not output list of places.')
     parser.add_argument('--message', default="Editorial adjustment (batch)",
@@ -141,121 +1096,139 @@ if __name__ == '__main__':
                         dest='contributors', nargs='+', help='Contributors. Separated by spaces.')
     parser.add_argument('--tags', default=[], dest='subjects', nargs='+',
                         help='Tags (subjects). Separated by spaces.')
-    parser.add_argument('file', type=file, help='Path to JSON import file')
+    parser.add_argument('--journal', default=None, dest='journal',
+                        help='Path to a local journal file. A rerun with the '
+                        'same journal skips work that was already committed.')
+    parser.add_argument('--phase', default='all', dest='phase',
+                        choices=['all', 'places', 'connections'],
+                        help='Load only places and their immediate '
+                        'connections ("places"), only the deferred '
+                        'connections of places already in the journal '
+                        '("connections"), or both ("all").')
+    parser.add_argument('--retries', default=5, type=int, dest='retries',
+                        help='Times to retry a transaction batch after a '
+                        'ConflictError.')
+    parser.add_argument('--bulk-index', default='off', dest='bulk_index',
+                        choices=['off', 'batch'],
+                        help='Defer catalog indexing of new and changed '
+                        'content and index each object once, at the end '
+                        'of each transaction batch ("batch").')
+    parser.add_argument('--commit-seconds', default=2.0, type=float,
+                        dest='commit_seconds', help='Target duration of each '
+                        'transaction commit; batch sizes adapt toward it. '
+                        '0 keeps them fixed. Defaults to 2.')
+    parser.add_argument('--batch-objects', default=BATCH_OBJECTS, type=int,
+                        dest='batch_objects', help='Objects per transaction '
+                        'to start with. Defaults to {}.'.format(BATCH_OBJECTS))
+    parser.add_argument('--savepoint-objects', default=1000, type=int,
+                        dest='savepoint_objects', help='Objects between '
+                        'savepoints within a transaction, to cap memory use. '
+                        '0 disables them. Defaults to 1000.')
+    parser.add_argument('--progress', default=60.0, type=float,
+                        dest='progress', help='Seconds between progress '
+                        'lines. Defaults to 60.')
+    parser.add_argument('--report', default=None, dest='report',
+                        help='Write timings and counters for the run to this '
+                        'path as JSON.')
+    parser.add_argument('file', type=argparse.FileType('r'),
+                        help='Path to JSON (array) or NDJSON import file, '
+                        'or "-" for standard input')
     parser.add_argument('-c', help='Optional Zope configuration file.')
+    return parser
+
+
+def begin_load(plone_site, args):
+    """Set up the state shared by the load functions for one run."""
+    global site, owner, reindex_queue, traversal_cache, id_registry
+    global places_folder, journal, loaded_ids, connections_pending
+    global deferred_indexing, stats, sizer, savepoints, rolled_back
+    global connections_unmade
+    site = plone_site
+    stats = LoadStats(site, args.progress)
+    sizer = TransactionSizer(args.batch_objects, args.commit_seconds)
+    savepoints = BatchSavepoints(args.savepoint_objects, args.dry_run)
+    # titles of places created and then rolled back by a dry run, and the
+    # deferred connections of those places
+    rolled_back = set()
+    connections_unmade = []
+    membership = getToolByName(site, "portal_membership")
+    owner = membership.getMemberById(args.owner).getUser()
+
+    # objects are reindexed once per transaction batch, just before commit
+    reindex_queue = ReindexQueue()
+    # avoid repeated ZODB lookups for objects and ids we have already seen
+    traversal_cache = TraversalCache(site)
+    id_registry = IdRegistry()
+    places_folder = traversal_cache.get('places')
+    # committed title -> id map and phase progress, for resuming
+    journal = Journal(args.journal)
+    journal.recover(places_folder)
+
+    loaded_ids = {}
+    connections_pending = OrderedDict()
+
+    # catalog writes held back for bulk indexing, if asked for
+    deferred_indexing = None
+    if args.bulk_index != 'off':
+        deferred_indexing = DeferredIndexing(
+            getToolByName(site, 'portal_catalog'))
+        deferred_indexing.install()
+
+
+if __name__ == '__main__':
+    parser = make_parser()
     try:
         args = parser.parse_args()
-    except IOError, msg:
+    except IOError as msg:
         parser.error(str(msg))
 
-    new_places = json.loads(args.file.read())
+    new_places = iter_places(args.file)
 
     app = spoofRequest(app)
-    site = getSite(app)
+    if args.preflight:
+        count, problems = preflight(new_places, getSite(app), args)
+        for problem in problems:
+            print(problem)
+        print('Preflight checked {} places: {} problems.'.format(
+            count, len(problems)))
+        sys.exit(1 if problems else 0)
+    begin_load(getSite(app), args)
     workflow = getToolByName(site, "portal_workflow")
-    membership = getToolByName(site, "portal_membership")
+    if journal.ids:
+        print('Resuming: {} places already loaded.'.format(len(journal.ids)))
 
     # create places and subordinate names and locations
-    loaded_ids = {}
-    connections_pending = {}
-    done = 0
     sys.stderr.flush()
-    print('Loading {} new places '.format(len(new_places)))
+    print('Loading new places from {}'.format(args.file.name))
     sys.stdout.flush()
-    for place in new_places:
-        content_type = 'Place'
-        path = 'places'
-        content = site.restrictedTraverse(path.encode('utf-8'))
-        new_id = content.generateId(prefix='')
-        content.invokeFactory(
-            'Place',
-            id=new_id,
-            title=place['title'])
-        loaded_ids[place['title']] = new_id
-        content = content[new_id]
-        for k, v in place.items():
-            if k in ['locations', 'names', 'connections', 'title']:
-                continue  # address these after the place is created in plone
-            populate_field(content, k, v)
-        set_attribution(content, args)
-        set_tags(content, args)
-
-        # create names
-        if len(place['names']) > 0:
-            populate_names(place, content, args)
-
-        # create locations
-        if len(place['locations']) > 0:
-            populate_locations(place, content, args)
-
-        # store connection info to create later
-        # (we may need other places to be in plone in order to create cnxn)
-        if len(place['connections']) > 0:
-            connections_pending[new_id] = place['connections']
-        
-        content.reindexObject()
-
-        done += 1
-        if not args.dry_run and done % 100 == 0:
-            transaction.commit()
+    run_batches(new_places, load_place, unload_place, args)
 
-    # create connections
+    # create deferred connections
     pprint(loaded_ids, indent=4)
-    path_base = 'places/'
-    done = 0
-    for place_id, connections in connections_pending.items():
-        from_path = path_base + place_id
-        from_place = site.restrictedTraverse(from_path.encode('utf-8'))
-        for connection in connections:
-            try:
-                to_id = loaded_ids[connection['connection']]
-            except KeyError:
-                to_id = FALLBACK_IDS[connection['connection']]
-                rtype = 'part_of_physical'
-            else:
-                rtype = connection['relationshipType']
-            cnxn_id = make_name_id(connection['connection'])
-            if cnxn_id in from_place.objectIds():
-                raise RuntimeError(
-                    'Connection id collision: {}'.format(cnxn_id))
-            to_path = path_base + to_id
-            to_place = site.restrictedTraverse(to_path.encode('utf-8'))
-            from_place.invokeFactory('Connection', id=cnxn_id)
-            cnxn_obj = from_place[cnxn_id]
-            cnxn_obj.setConnection([to_place.UID()])
-            cnxn_obj.setTitle(connection['connection'])
-            cnxn_obj.setRelationshipType(rtype)
-            set_attribution(cnxn_obj, args)
-
-            to_place.reindexObject()
-
-        from_place.reindexObject()
-
-        done += 1
-        if not args.dry_run and done % 100 == 0:
-            transaction.commit()
-
-    # ownership and group permissions
-    for title, place_id in loaded_ids.items():
-        place_path = path_base + place_id
-        place_obj = site.restrictedTraverse(place_path.encode('utf-8'))
-        member = membership.getMemberById(args.owner)
-        user = member.getUser()
-        place_obj.changeOwnership(user, recursive=True)
-        place_obj.manage_setLocalRoles(args.owner, ["Owner",])
-        for group in args.groups:
-            place_obj.manage_setLocalRoles(
-                group, ['Reader', 'Editor', 'Contributor'])
-        place_obj.reindexObjectSecurity()
+    if args.phase != 'places':
+        run_batches(
+            list(connections_pending.items()), load_connections,
+            lambda item: None, args)
+        for item in connections_unmade:
+            check_connections(item, loaded_ids)
+    if deferred_indexing is not None:
+        deferred_indexing.uninstall()
 
     if args.dry_run:
         # abandon everything we've done, leaving the ZODB unchanged
+        reindex_queue.flush()
         transaction.abort()
         print('Dry run. No changes made in Plone.')
+        if stats.skipped:
+            print('{} connections to or from places rolled back with an '
+                  'earlier batch were checked but not made.'.format(
+                      stats.skipped))
     else:
-        # make all remaining changes to the database
-        transaction.commit()
         print('Place creation and reindexing complete.')
+    stats.progress(force=True)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(stats.to_dict(), f, indent=4)
 
     # output a list of all the places that have been created
     if not args.nolist:
@@ -0,0 +1,120 @@
+import codecs
+import json
+import os
+import re
+
+
+# Shared by loader.py, which runs inside Zope, and coordinator.py, which
+# does not, so this module must not import anything from Zope or Plone.
+READ_SIZE = 64 * 1024
+RX_NONSPACE = re.compile(r'\S')
+
+
+def iter_places(f):
+    """Yield places one at a time from a JSON array or NDJSON file.
+
+    Only the place being decoded (plus one read) is held in memory. NDJSON
+    lines are yielded as soon as they are complete, so places arriving
+    through a pipe are not held back. A place in a JSON array is decoded
+    again only once the text after the previous place has doubled, which
+    keeps large places from being decoded over and over.
+    """
+    chunks = read_chunks(f)
+    m = None
+    while m is None:
+        buf = next(chunks, None)
+        if buf is None:
+            return
+        m = RX_NONSPACE.search(buf)
+    if buf[m.start()] == '[':
+        places = iter_array(buf, m.end(), chunks)
+    else:
+        places = iter_ndjson(buf[m.start():], chunks)
+    for place in places:
+        yield place
+
+
+def read_chunks(f):
+    """Yield the text of a UTF-8 file in chunks of up to READ_SIZE.
+
+    A real file is read with os.read(), which returns what a pipe has
+    ready instead of waiting for a whole chunk.
+    """
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        fd = None
+    if fd is None:
+        chunk = f.read(READ_SIZE)
+        while chunk:
+            yield chunk
+            chunk = f.read(READ_SIZE)
+        return
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = os.read(fd, READ_SIZE)
+        text = decoder.decode(data, not data)
+        if text:
+            yield text
+        if not data:
+            return
+
+
+def iter_ndjson(buf, chunks):
+    pieces = []  # the text of an incomplete line
+    while buf is not None:
+        lines = buf.split('\n')
+        if len(lines) > 1:
+            lines[0] = ''.join(pieces) + lines[0]
+            pieces = []
+            for line in lines[:-1]:
+                if line.strip():
+                    yield json.loads(line)
+        pieces.append(lines[-1])
+        buf = next(chunks, None)
+    line = ''.join(pieces)
+    if line.strip():
+        yield json.loads(line)
+
+
+def iter_array(buf, pos, chunks):
+    decoder = json.JSONDecoder()
+    pieces = []  # chunks read since buf was last extended
+    size = 0  # and their length
+    need = 0  # length of the place's text before decoding it again
+    eof = False
+    while True:
+        m = RX_NONSPACE.search(buf, pos)
+        if m is None:
+            # nothing but space is left in buf
+            buf, pos = next(chunks, None), 0
+            if buf is None:
+                raise ValueError('Unexpected end of JSON array input.')
+            continue
+        start = m.start()
+        if buf[start] == ',':
+            pos = m.end()
+            continue
+        if buf[start] == ']':
+            return
+        if len(buf) - start + size < need and not eof:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                pieces.append(chunk)
+                size += len(chunk)
+            continue
+        if pieces:
+            buf, start = buf[start:] + ''.join(pieces), 0
+            pieces, size = [], 0
+        try:
+            place, pos = decoder.raw_decode(buf, start)
+        except ValueError:
+            if eof:
+                raise
+            buf, pos = buf[start:], 0  # incomplete; read more
+            need = 2 * len(buf)
+            continue
+        need = 0
+        yield place
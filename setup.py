@@ -18,6 +18,6 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    install_requires=['airtight', 'encoded_csv', 'shapely'],
+    install_requires=['airtight', 'chardet', 'encoded_csv', 'shapely'],
     python_requires='>=3.9.1'
 )
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the scripts are not a package; import them as top-level modules
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+)
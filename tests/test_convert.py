@@ -0,0 +1,274 @@
+import codecs
+import csv
+import json
+import random
+
+import encoded_csv
+import pytest
+
+import convert
+
+
+@pytest.fixture(autouse=True)
+def reset_state(monkeypatch):
+    monkeypatch.setattr(convert, "errors", convert.ErrorReport())
+    monkeypatch.setattr(convert, "fault_tolerant", False)
+    # split even small files into many chunks
+    monkeypatch.setattr(convert, "MIN_CHUNK_BYTES", 64)
+
+
+def write_records(path, records, newline="\n", bom=b""):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, lineterminator=newline)
+        writer.writerow(["a", "b", "c"])
+        writer.writerows(records)
+    if bom:
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(bom + data)
+    return str(path)
+
+
+def multiline_records(count, newline="\n"):
+    return [
+        [f"x{i}", f'line one{newline}line "two" {i}', f"z{i}"] for i in range(count)
+    ]
+
+
+def test_split_records_skips_newlines_in_quoted_fields():
+    data = b'a,b\n1,"x\ny"\n2,z\n'
+    # a target inside the quoted field moves to the end of its record
+    assert convert.split_records(data, 4, [7], b'"') == [12]
+    assert convert.split_records(data, 4, [4, 12], b'"') == [12, 16]
+
+
+def test_split_records_drops_targets_past_the_last_boundary():
+    data = b'a,b\n1,"x\ny"\n2,z'
+    assert convert.split_records(data, 4, [7, 13], b'"') == [12]
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+@pytest.mark.parametrize("bom", [b"", codecs.BOM_UTF8])
+def test_read_csv_parallel_matches_serial_reader(tmp_path, newline, bom):
+    fn = write_records(
+        tmp_path / "in.csv", multiline_records(40, newline), newline, bom
+    )
+    parallel = convert.read_csv_parallel(fn, 3)
+    serial = encoded_csv.get_csv(fn)
+    assert parallel["fieldnames"] == ["a", "b", "c"]
+    assert parallel["content"] == serial["content"]
+    assert len(parallel["content"]) == 40
+
+
+def test_read_csv_parallel_keeps_ragged_records_like_dictreader(tmp_path):
+    records = multiline_records(40)
+    records[5] = ["short"]
+    records[30] = ["x", "y", "z", "extra", "more"]
+    fn = write_records(tmp_path / "in.csv", records)
+    parallel = convert.read_csv_parallel(fn, 3)
+    assert parallel["content"] == encoded_csv.get_csv(fn)["content"]
+    assert parallel["content"][5] == {"a": "short", "b": None, "c": None}
+    assert parallel["content"][30][None] == ["extra", "more"]
+
+
+def test_read_csv_parallel_falls_back_on_quote_in_unquoted_field(tmp_path):
+    lines = ["a,b,c"] + [f'x{i},"line one\nline two {i}",z{i}' for i in range(40)]
+    # a quote character in an unquoted field throws the quote count off
+    lines[4] = 'x3,5" wide,z3'
+    fn = tmp_path / "in.csv"
+    fn.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    serial = encoded_csv.get_csv(str(fn))
+    assert len(serial["content"]) == 40
+    assert serial["content"][3]["b"] == '5" wide'
+    assert convert.read_csv_parallel(str(fn), 3) is None
+
+
+def reachable(graph, start):
+    seen = set()
+    stack = list(graph[start])
+    while stack:
+        node = stack.pop()
+        if node not in seen:
+            seen.add(node)
+            stack.extend(graph[node])
+    return seen
+
+
+def random_graph(rng, count):
+    return {
+        node: rng.sample(range(count), rng.choice([0, 0, 1, 1, 2, 3]))
+        for node in rng.sample(range(count), count)
+    }
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_order_places(seed):
+    rng = random.Random(seed)
+    graph = random_graph(rng, rng.randrange(1, 40))
+    ordered, cyclic = convert.order_places(graph)
+    assert sorted(ordered) == sorted(graph)
+    reach = {node: reachable(graph, node) for node in graph}
+    assert cyclic == {node for node in graph if node in reach[node]}
+    position = {node: i for i, node in enumerate(ordered)}
+    for node, targets in graph.items():
+        for target in targets:
+            if node not in reach[target]:  # not in the same cycle
+                assert position[target] < position[node]
+
+
+CSV_COLUMNS = [
+    "accuracy_document",
+    "Alias",
+    "Description",
+    "P576 dissolved/demolished",
+    "Coordinate location GEOJSON",
+    "Inception",
+    "Place type",
+    "Source",
+    "Title",
+    "Location",
+    "Part of (larger organizational unit at D-E)",
+    "Structure replaces",
+]
+
+
+def ydea_row(i, targets=(), replaces="", **fields):
+    """Return a CSV row for block i; fields override columns by name."""
+    x, y = 40.7 + i * 1e-5, 34.7
+    ring = [[x, y], [x + 1e-4, y], [x + 1e-4, y + 1e-4], [x, y]]
+    row = {
+        "accuracy_document": "dura-europos-block-l7-chen",
+        "Alias": f"Block {i}",
+        "Description": f"a block with traces {i}",
+        "P576 dissolved/demolished": "256 CE",
+        "Coordinate location GEOJSON": json.dumps(
+            {"type": "Polygon", "coordinates": [ring]}
+        ),
+        "Inception": "c. 200 BCE",
+        "Place type": "city block",
+        "Source": "Baird 2018, p. 12",
+        "Title": f"block {i}",
+        "Location": "Dura-Europos",
+        "Part of (larger organizational unit at D-E)": "; ".join(
+            f"block {j}" for j in targets
+        ),
+        "Structure replaces": replaces,
+    }
+    row.update(fields)
+    return [row[column] for column in CSV_COLUMNS]
+
+
+def write_ydea_rows(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_COLUMNS)
+        writer.writerows(rows)
+    return str(path)
+
+
+def write_ydea(path, rng, count):
+    rows = []
+    for i in rng.sample(range(count), count):
+        targets = rng.sample(range(count), rng.choice([0, 1, 1, 2]))
+        rows.append(
+            ydea_row(
+                i,
+                [j for j in targets if j != i],
+                f"block {rng.randrange(count)}" if rng.random() < 0.1 else "",
+            )
+        )
+    return write_ydea_rows(path, rows)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_stream_places_matches_make_pjson(tmp_path, seed):
+    rng = random.Random(seed)
+    fn = write_ydea(tmp_path / "in.csv", rng, rng.randrange(1, 60))
+    batch = convert.make_pjson(convert.read_ydea(fn))
+    stream = list(convert.stream_places(convert.read_ydea(fn)))
+    assert {place.title: place.to_dict() for place in stream} == {
+        place.title: place.to_dict() for place in batch
+    }
+    for places in [batch, stream]:
+        seen = set()
+        for place in places:
+            if not place.connection_cycle:
+                for connection in place.connections:
+                    if connection.target.startswith("https://"):
+                        continue
+                    assert connection.target in seen
+            seen.add(place.title)
+
+
+# (row, category) of each quarantined row in bad_ydea_rows()
+BAD_ROWS = [
+    (2, "place_type"),
+    (3, "reference"),
+    (4, "date"),
+    (5, "connection"),
+    (6, "title_collision"),
+    (7, "connection"),
+    (8, "connection"),
+]
+
+
+def bad_ydea_rows():
+    """Return rows 1-9 of an import in which rows 2-8 are quarantined."""
+    return [
+        ydea_row(0),
+        ydea_row(1, **{"Place type": "moat"}),
+        ydea_row(2, Source="Nobody 1999, p. 3"),
+        ydea_row(3, Inception="whenever"),
+        ydea_row(4, [99]),
+        ydea_row(5, Title="block 0"),
+        ydea_row(6, [3]),  # connects to a quarantined place
+        ydea_row(7, [0, 6]),  # and this to one quarantined for that
+        ydea_row(8, [0]),
+    ]
+
+
+@pytest.mark.parametrize("build", ["make_pjson", "stream_places"])
+def test_fault_tolerant_quarantines_bad_rows(tmp_path, monkeypatch, build):
+    monkeypatch.setattr(convert, "fault_tolerant", True)
+    fn = write_ydea_rows(tmp_path / "in.csv", bad_ydea_rows())
+    places = list(getattr(convert, build)(convert.read_ydea(fn)))
+    assert sorted(place.title for place in places) == ["Block 0", "Block 8"]
+    report = convert.errors.to_dict()
+    assert [(e["row"], e["category"]) for e in report["errors"]] == BAD_ROWS
+    assert report["counts"] == {
+        "connection": 3,
+        "date": 1,
+        "place_type": 1,
+        "reference": 1,
+        "title_collision": 1,
+    }
+    assert report["quarantined_rows"] == 7
+    titles = {e["row"]: e["title"] for e in report["errors"]}
+    assert titles[6] == "Block 0"  # the title that collided
+    assert titles[8] == "Block 7"
+
+
+def test_row_errors_stop_the_run_unless_fault_tolerant(tmp_path):
+    fn = write_ydea_rows(tmp_path / "in.csv", [ydea_row(0), ydea_row(1, [99])])
+    with pytest.raises(convert.RowError) as excinfo:
+        convert.make_pjson(convert.read_ydea(fn))
+    assert excinfo.value.category == "connection"
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_stream_places_reports_errors_as_make_pjson_does(
+    tmp_path, monkeypatch, seed
+):
+    monkeypatch.setattr(convert, "fault_tolerant", True)
+    rows = bad_ydea_rows()
+    random.Random(seed).shuffle(rows)
+    fn = write_ydea_rows(tmp_path / "in.csv", rows)
+    batch = convert.make_pjson(convert.read_ydea(fn))
+    batch_report = convert.errors.to_dict()
+    monkeypatch.setattr(convert, "errors", convert.ErrorReport())
+    stream = list(convert.stream_places(convert.read_ydea(fn)))
+    assert sorted(place.title for place in stream) == sorted(
+        place.title for place in batch
+    )
+    assert convert.errors.to_dict() == batch_report
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+import coordinator
+
+
+def write_journal(path, entries):
+    path.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    return str(path)
+
+
+def read_journal(path):
+    return [json.loads(line) for line in open(path) if line.strip()]
+
+
+def batch(number, places=(), connections=()):
+    return {
+        "batch": number,
+        "places": [list(place) for place in places],
+        "connections": list(connections),
+    }
+
+
+@pytest.mark.parametrize(
+    "count, n, sizes",
+    [
+        (10, 3, [4, 4, 2]),
+        (9, 3, [3, 3, 3]),
+        (2, 5, [1, 1]),
+        (1, 1, [1]),
+        (0, 3, []),
+    ],
+)
+def test_partition(count, n, sizes):
+    assert coordinator.partition(count, n) == sizes
+
+
+def test_partition_covers_every_place():
+    for count in range(30):
+        for n in range(1, 8):
+            sizes = coordinator.partition(count, n)
+            assert sum(sizes) == count
+            assert len(sizes) <= n
+            assert all(size > 0 for size in sizes)
+
+
+def test_write_partitions_splits_an_import_in_order(tmp_path):
+    places = [{"title": f"Place {i}"} for i in range(10)]
+    path = tmp_path / "import.json"
+    path.write_text(json.dumps(places))
+    part_paths = [str(tmp_path / f"part-{i}.ndjson") for i in range(3)]
+    coordinator.write_partitions(str(path), coordinator.partition(10, 3), part_paths)
+    parts = [read_journal(part_path) for part_path in part_paths]
+    assert parts == [places[:4], places[4:8], places[8:]]
+
+
+def test_merge_journals_renumbers_confirmed_batches(tmp_path):
+    first = write_journal(
+        tmp_path / "journal-0.jsonl",
+        [
+            batch(1, [("A", "1", False), ("B", "2", True)]),
+            {"committed": 1},
+            batch(2, [("C", "3", False)]),
+            {"aborted": 2},
+            batch(3, [("C", "4", False)]),
+            {"committed": 3},
+        ],
+    )
+    second = write_journal(
+        tmp_path / "journal-1.jsonl",
+        [batch(1, [("D", "5", True)]), {"committed": 1}],
+    )
+    merged = str(tmp_path / "journal.jsonl")
+    assert coordinator.merge_journals([first, second], merged) == 4
+    assert read_journal(merged) == [
+        batch(1, [("A", "1", False), ("B", "2", True)]),
+        {"committed": 1},
+        batch(2, [("C", "4", False)]),
+        {"committed": 2},
+        batch(3, [("D", "5", True)]),
+        {"committed": 3},
+    ]
+
+
+def test_merge_journals_rejects_a_place_loaded_twice(tmp_path):
+    paths = [
+        write_journal(
+            tmp_path / f"journal-{i}.jsonl",
+            [batch(1, [("A", str(i), False)]), {"committed": 1}],
+        )
+        for i in range(2)
+    ]
+    merged = tmp_path / "journal.jsonl"
+    with pytest.raises(RuntimeError, match="more than one worker"):
+        coordinator.merge_journals(paths, str(merged))
+    assert not merged.exists()
+
+
+def test_read_confirmed_rejects_unconfirmed_batches(tmp_path):
+    path = write_journal(
+        tmp_path / "journal-0.jsonl",
+        [
+            batch(1, [("A", "1", False)]),
+            {"committed": 1},
+            batch(2, [("B", "2", False)]),
+        ],
+    )
+    with pytest.raises(RuntimeError, match="unconfirmed batches"):
+        coordinator.read_confirmed(path)
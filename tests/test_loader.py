@@ -0,0 +1,233 @@
+import json
+import os
+import pickle
+import sys
+
+import pytest
+
+import fakeplone
+
+fakeplone.install()
+import bench_loader  # noqa: E402
+import loader  # noqa: E402
+
+def write_journal(path, entries):
+    path.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    return str(path)
+
+
+def read_journal(path):
+    return [json.loads(line) for line in open(path) if line.strip()]
+
+
+def batch(number, places=(), connections=()):
+    return {
+        "batch": number,
+        "places": [list(place) for place in places],
+        "connections": list(connections),
+    }
+
+
+def test_journal_load_keeps_only_committed_batches(tmp_path):
+    path = write_journal(
+        tmp_path / "journal.jsonl",
+        [
+            batch(1, [("A", "1", False), ("B", "2", True)]),
+            {"committed": 1},
+            batch(2, [("C", "3", False)]),
+            {"aborted": 2},
+            batch(3, [], ["2"]),
+            {"committed": 3},
+            batch(4, [("D", "4", False)]),
+        ],
+    )
+    journal = loader.Journal(path)
+    assert dict(journal.ids) == {"A": "1", "B": "2"}
+    assert journal.deferred == {"2"}
+    assert journal.connected == {"2"}
+    assert [entry["batch"] for entry in journal.unconfirmed] == [4]
+    assert journal.batch == 4
+
+
+def test_journal_round_trip(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = loader.Journal(path)
+    journal.record_place("A", "1", True)
+    journal.prepare()
+    journal.commit()
+    journal.record_place("B", "2", False)
+    journal.prepare()
+    journal.abort()
+    journal.prepare()  # an empty batch is not written
+    journal.commit()
+    journal.record_connected("1")
+    journal.prepare()
+    journal.commit()
+
+    reloaded = loader.Journal(path)
+    assert dict(reloaded.ids) == {"A": "1"}
+    assert reloaded.deferred == {"1"}
+    assert reloaded.connected == {"1"}
+    assert reloaded.unconfirmed == []
+    assert len(read_journal(path)) == 6
+
+
+def test_journal_recover_checks_unconfirmed_batches_against_the_site(tmp_path):
+    site = fakeplone.make_site()
+    places = site["places"]
+    places.invokeFactory("Place", "10")
+    path = write_journal(
+        tmp_path / "journal.jsonl",
+        [
+            # committed, but the process died before confirming it
+            batch(1, [("A", "10", True), ("B", "11", False)]),
+            # never committed
+            batch(2, [("C", "12", False)]),
+            # connections only: they may or may not exist
+            batch(3, [], ["10"]),
+        ],
+    )
+    journal = loader.Journal(path)
+    journal.recover(places)
+    assert dict(journal.ids) == {"A": "10", "B": "11"}
+    assert journal.deferred == {"10"}
+    assert journal.connected == set()
+    assert journal.verify == {"10"}
+    assert journal.unconfirmed == []
+    assert read_journal(path)[3:] == [
+        {"committed": 1},
+        {"aborted": 2},
+        {"aborted": 3},
+    ]
+
+    # the rewritten journal needs no recovery
+    reloaded = loader.Journal(path)
+    assert reloaded.unconfirmed == []
+    assert dict(reloaded.ids) == {"A": "10", "B": "11"}
+
+
+def test_journal_without_path_is_kept_in_memory():
+    journal = loader.Journal()
+    journal.record_place("A", "1", False)
+    journal.prepare()
+    journal.commit()
+    assert dict(journal.ids) == {"A": "1"}
+
+
+def run_load(monkeypatch, site, places, argv, state, conflicts=()):
+    fakeplone.install(site, state, conflicts)
+    monkeypatch.setattr(loader, "transaction", sys.modules["transaction"])
+    args = loader.make_parser().parse_args(argv + [os.devnull])
+    args.file.close()
+    loader.begin_load(site, args)
+    loader.run_batches(iter(places), loader.load_place, loader.unload_place, args)
+    loader.run_batches(
+        list(loader.connections_pending.items()),
+        loader.load_connections,
+        lambda item: None,
+        args,
+    )
+
+
+def test_rerun_with_journal_resumes_an_interrupted_load(tmp_path, monkeypatch):
+    places = bench_loader.make_places(60, 1, 1, 2)
+    state = str(tmp_path / "site.pkl")
+    argv = [
+        "--journal",
+        str(tmp_path / "journal.jsonl"),
+        "--retries",
+        "0",
+        "--batch-objects",
+        "40",
+        "--commit-seconds",
+        "0",
+    ]
+    site = fakeplone.make_site()
+    with pytest.raises(fakeplone.ConflictError):
+        run_load(monkeypatch, site, places, argv, state, conflicts=[3])
+
+    # a new process starts from what was committed
+    with open(state, "rb") as f:
+        site = pickle.load(f)
+    committed = len(site["places"].objectIds())
+    assert 2 < committed < 62
+    run_load(monkeypatch, site, places, argv, state)
+
+    titles = [
+        place.fields["title"]
+        for place in site["places"].children.values()
+        if "title" in place.fields
+    ]
+    assert sorted(titles) == sorted(place["title"] for place in places)
+    connections = sum(
+        1
+        for place in site["places"].children.values()
+        for child in place.children.values()
+        if child.portal_type == "Connection"
+    )
+    assert connections == sum(len(place["connections"]) for place in places)
+
+
+def test_deferred_indexing_indexes_each_object_once_per_batch(monkeypatch):
+    site = fakeplone.make_site()
+    fakeplone.install(site)
+    monkeypatch.setattr(loader, "stats", loader.LoadStats(site))
+    catalog = site.portal_catalog
+    other = fakeplone.CatalogTool(site)
+    own = fakeplone.CatalogTool.__dict__["catalog_object"]
+    place = site["places"]["893990"]
+    target = site["places"]["15685985"]
+    catalog.indexed.clear()
+    fakeplone.calls.reset()
+    deferral = loader.DeferredIndexing(fakeplone.Wrapper(catalog))
+    deferral.install()
+    try:
+        # each lookup of the tool is a new wrapper, as under Acquisition
+        place.reindexObject(["Title"])
+        place.reindexObject(["Title", "connectsWith"])
+        target.reindexObject(["hasConnectionsWith"])
+        target.reindexObject()  # a full reindex takes in the partial one
+        fakeplone.Wrapper(other).reindexObject(place, ["Title"])
+        assert catalog.indexed == {}
+        assert other.indexed == {"plone/places/893990": {"Title"}}
+        assert fakeplone.calls.counts["catalog_object"] == 1
+        deferral.flush()
+    finally:
+        deferral.uninstall()
+    assert catalog.indexed == {
+        "plone/places/893990": {"Title", "connectsWith"},
+        "plone/places/15685985": set(fakeplone.CATALOG_INDEXES),
+    }
+    assert fakeplone.calls.counts["catalog_object"] == 3
+    assert loader.stats.batch_objects() == 0
+    assert fakeplone.CatalogTool.__dict__["catalog_object"] is own
+
+
+def test_preflight_reports_problems_without_creating_anything():
+    site = fakeplone.make_site()
+    fakeplone.install(site)
+    places = bench_loader.make_places(3, 2, 1, 1)
+    places[0]["bogus"] = "x"
+    places[1]["locations"][0]["accuracy"] = "/features/metadata/missing"
+    places[2]["connections"].extend(
+        [
+            {"connection": "City wall of Dura-Europos", "relationshipType": "at"},
+            {"connection": "Nowhere", "relationshipType": "at"},
+        ]
+    )
+    places[2]["names"][1]["nameTransliterated"] = "Block 2 name 0"
+    args = loader.make_parser().parse_args([os.devnull])
+    args.file.close()
+    fakeplone.calls.reset()
+    count, problems = loader.preflight(places, site, args)
+    assert count == 3
+    assert problems == [
+        'Place "Block 2": name "Block 2 name 0" and name "Block 2 name 0" '
+        'both get id "block-2-name-0".',
+        'Place has no field "bogus" (first used by "Block 0").',
+        'Place "Block 2": connection target "Nowhere" is neither in the '
+        "import nor in FALLBACK_IDS.",
+        'Place "Block 1": accuracy "/features/metadata/missing" not found.',
+    ]
+    assert fakeplone.calls.counts["invokeFactory"] == 0
+    assert fakeplone.calls.counts["unrestrictedSearchResults"] == 1
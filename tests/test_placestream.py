@@ -0,0 +1,94 @@
+import io
+import json
+import os
+
+import pytest
+
+import placestream
+
+PLACES = [
+    {"title": f"Place {i}", "text": "x" * (i * 37 % 500), "n": [i, {"s": "]},"}]}
+    for i in range(200)
+]
+BIG_PLACE = {"title": "Big", "names": ["z" * 100] * 20000}
+
+
+@pytest.fixture
+def reader(monkeypatch):
+    # small reads, so that places span many of them
+    monkeypatch.setattr(placestream, "READ_SIZE", 100)
+    return placestream.iter_places
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        json.dumps(PLACES, indent=4),
+        json.dumps(PLACES, separators=(",", ":")),
+        "\n" + "".join(json.dumps(place) + "\n\n" for place in PLACES),
+        "\n".join(json.dumps(place) for place in PLACES),
+    ],
+    ids=["array", "compact-array", "ndjson", "ndjson-no-final-newline"],
+)
+def test_iter_places(reader, text):
+    assert list(reader(io.StringIO(text))) == PLACES
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        json.dumps([PLACES[0], BIG_PLACE, PLACES[1]]),
+        "\n".join(json.dumps(place) for place in [PLACES[0], BIG_PLACE, PLACES[1]]),
+    ],
+    ids=["array", "ndjson"],
+)
+def test_iter_places_with_a_place_larger_than_a_read(reader, text):
+    assert list(reader(io.StringIO(text))) == [PLACES[0], BIG_PLACE, PLACES[1]]
+
+
+def test_iter_places_reads_files_as_utf8(reader, tmp_path):
+    path = tmp_path / "import.json"
+    places = [{"title": "\u00e9\u4e2d" * 100}] * 3
+    path.write_bytes(json.dumps(places, ensure_ascii=False).encode("utf-8"))
+    with open(str(path)) as f:
+        assert list(reader(f)) == places
+
+
+def test_iter_places_yields_ndjson_lines_as_they_arrive(reader):
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd) as f:
+        os.write(write_fd, (json.dumps(PLACES[0]) + "\n").encode("utf-8"))
+        places = reader(f)
+        # the writer is still open, so this must not wait for a full read
+        assert next(places) == PLACES[0]
+        os.write(write_fd, json.dumps(PLACES[1]).encode("utf-8"))
+        os.close(write_fd)
+        assert list(places) == [PLACES[1]]
+
+
+@pytest.mark.parametrize("text", ["", " \n ", "[]", " [ ] "])
+def test_iter_places_with_no_places(reader, text):
+    assert list(reader(io.StringIO(text))) == []
+
+
+@pytest.mark.parametrize("text", ['[{"a": 1}, {"b": ', '[{"a": 1}'])
+def test_iter_places_with_truncated_array(reader, text):
+    with pytest.raises(ValueError):
+        list(reader(io.StringIO(text)))
+
+
+def test_iter_places_decodes_a_large_place_a_few_times(monkeypatch):
+    decodes = []
+    raw_decode = json.JSONDecoder.raw_decode
+
+    def counting_raw_decode(self, s, idx=0):
+        decodes.append(len(s) - idx)
+        return raw_decode(self, s, idx)
+
+    monkeypatch.setattr(json.JSONDecoder, "raw_decode", counting_raw_decode)
+    monkeypatch.setattr(placestream, "READ_SIZE", 100)
+    text = json.dumps([BIG_PLACE], indent=1)
+    assert list(placestream.iter_places(io.StringIO(text))) == [BIG_PLACE]
+    # the text decoded grows geometrically, not by one read at a time
+    assert len(decodes) < 25
+    assert sum(decodes) < 4 * len(text)